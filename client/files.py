@@ -8,11 +8,21 @@ License       GPL version 2 (see GPL.txt for details)
 
 __author__ = "enrico"
 
+import bz2
+import collections
+import errno
 import hashlib
 import json
+import lzma
 import os
+import queue
+import sqlite3
 import stat
+import struct
 import subprocess
+import threading
+import time
+import zlib
 
 if os.name == "posix":
     import grp
@@ -112,24 +122,399 @@ class FileMode(object):
 
         return result
 
+class HashCache(object):
+    _conn = None
+    _size = None
+
+    def __init__(self, path, size=1000000, algorithm="md5"):
+        self._size = size
+        self._algorithm = algorithm
+        self._lock = threading.Lock()
+        self._stored = []
+        self._used = []
+        self._generation = int(time.time())
+
+        self.hits = 0
+        self.misses = 0
+
+        # Cache can be shared by concurrent listings (threads or processes)
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        # Digests cached before algorithms were selectable are discarded
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(hashes)")]
+        if columns and "algorithm" not in columns:
+            self._conn.execute("DROP TABLE hashes")
+
+        self._conn.execute(" ".join(["CREATE TABLE IF NOT EXISTS hashes (",
+                                     "dev INTEGER, ino INTEGER, size INTEGER,",
+                                     "mtime INTEGER, ctime INTEGER, algorithm TEXT,",
+                                     "digest TEXT, used INTEGER,",
+                                     "PRIMARY KEY (dev, ino, size, mtime, ctime, algorithm))"]))
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_hashes_1 ON hashes(used)")
+
+        # Rows are counted once, then estimated by the stored ones
+        self._count = self._conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _key(self, st):
+        return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, self._algorithm]
+
+    def lookup(self, st):
+        key = self._key(st)
+
+        with self._lock:
+            row = self._conn.execute(" ".join(["SELECT digest FROM hashes WHERE",
+                                               "dev = ? AND ino = ? AND size = ? AND mtime = ? AND ctime = ?",
+                                               "AND algorithm = ?"]),
+                                     key).fetchone()
+            if row:
+                self.hits += 1
+                self._used.append([self._generation] + key)
+                if len(self._used) >= 1000:
+                    self._flush()
+                return row[0]
+            else:
+                self.misses += 1
+                return None
+
+    def store(self, st, digest):
+        # A file modified in the last seconds can change again without
+        # changing its timestamps, so it is not cached
+        if time.time() - st.st_mtime < 2:
+            return
+
+        with self._lock:
+            self._stored.append(self._key(st) + [digest, self._generation])
+            if len(self._stored) >= 1000:
+                self._flush()
+
+    def _flush(self):
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(" ".join(["INSERT OR REPLACE INTO hashes",
+                                             "(dev, ino, size, mtime, ctime, algorithm, digest, used)",
+                                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"]), self._stored)
+            self._conn.executemany(" ".join(["UPDATE hashes SET used = ? WHERE",
+                                             "dev = ? AND ino = ? AND size = ? AND mtime = ? AND ctime = ?",
+                                             "AND algorithm = ?"]),
+                                   self._used)
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        # Cache is bounded also while a long listing is running
+        self._count += len(self._stored)
+        if self._count > self._size:
+            self._evict()
+
+        self._stored = []
+        self._used = []
+
+    def _evict(self):
+        # Least recently used entries are evicted when the cache is full
+        count = self._conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        if count > self._size:
+            self._conn.execute(" ".join(["DELETE FROM hashes WHERE rowid IN",
+                                         "(SELECT rowid FROM hashes ORDER BY used LIMIT ?)"]),
+                               [count - self._size])
+        self._count = min(count, self._size)
+
+    def close(self):
+        with self._lock:
+            if not self._conn:
+                return
+
+            try:
+                self._flush()
+                self._evict()
+            finally:
+                self._conn.close()
+                self._conn = None
+
+CODECS = ["none", "zlib", "lzma", "bz2"]
+
+# Compression levels accepted by every codec
+LEVELS = {"zlib": range(-1, 10), "lzma": range(0, 10), "bz2": range(1, 10)}
+
+# Content hashes, BLAKE2 ones with the digest size in bytes (as blake2b-32)
+HASHES = ["md5", "sha1", "sha256", "sha512", "blake2b", "blake2s"]
+
+# Block signature (weak and strong checksum) and copy instruction of delta
+DELTA_SIGNATURE = struct.Struct(">I16s")
+DELTA_COPY = struct.Struct(">QI")
+
+# Metadata of a directory child covered by the directory digest
+DIGEST_ENTRY = struct.Struct("<IIIqqq")
+
+ACL_HEADER = struct.Struct("<I")
+ACL_ENTRY = struct.Struct("<HHI")
+ACL_VERSION = 0x0002
+ACL_USER_OBJ = 0x01
+ACL_USER = 0x02
+ACL_GROUP_OBJ = 0x04
+ACL_GROUP = 0x08
+ACL_MASK = 0x10
+ACL_OTHER = 0x20
+ACL_UNDEFINED_ID = 0xffffffff
+
+# Octal representation of every permission bits combination
+MODES = [FileMode(mode).mode_to_octal() for mode in range(0o10000)]
+
+class ParallelWalk(object):
+    _list = None
+    _workers = None
+    _inflight = None
+
+    def __init__(self, lst, workers, inflight):
+        self._list = lst
+        self._workers = workers
+        self._inflight = inflight
+
+        # Every worker owns a deque: it takes tasks from the tail of its own
+        # and steals from the head of the others when it is empty
+        self._queues = [collections.deque() for _ in range(workers)]
+        self._output = queue.Queue(maxsize=inflight)
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._pending = 0
+        self._alive = workers
+        self._error = None
+
+    def _push(self, index, task):
+        with self._cond:
+            self._pending += 1
+            self._queues[index].append(task)
+            self._cond.notify()
+
+    def _next(self, index):
+        try:
+            return self._queues[index].pop()
+        except IndexError:
+            pass
+
+        for offset in range(1, self._workers):
+            try:
+                return self._queues[(index + offset) % self._workers].popleft()
+            except IndexError:
+                pass
+
+        return None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._output.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def _end(self):
+        # End marker is always queued, also when the walk is stopped by an
+        # error: results not read yet are dropped to make room for it
+        while True:
+            try:
+                self._output.put(None, timeout=0.1)
+                return
+            except queue.Full:
+                if self._stop.is_set():
+                    try:
+                        self._output.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _run(self, index, task):
+        kind, path, st = task
+
+        if kind == "file":
+            self._put(self._list._dump(path, st))
+            return
+
+        if self._list._unchanged(path):
+            self._put(self._list._dump(path, st))
+            self._put(self._list._marker(path))
+            return
+
+        scanned = self._list._scan(path)
+        if scanned is None:
+            return
+        dirs, files = scanned
+
+        for entry in dirs:
+            if entry.is_symlink():
+                files.append(entry)
+            else:
+                self._push(index, ("directory", entry.path, entry.stat(follow_symlinks=False)))
+
+        for entry in files:
+            # When too many files are in flight, the entry is processed here
+            if self._pending < self._inflight:
+                self._push(index, ("file", entry.path, entry.stat(follow_symlinks=False)))
+            else:
+                self._put(self._list._dump(entry.path, entry.stat(follow_symlinks=False)))
+
+        self._put(self._list._dump(path, st))
+
+    def _work(self, index):
+        try:
+            while not self._stop.is_set():
+                task = self._next(index)
+
+                if task is None:
+                    with self._cond:
+                        if self._pending == 0:
+                            break
+                        self._cond.wait(0.1)
+                    continue
+
+                try:
+                    self._run(index, task)
+                finally:
+                    with self._cond:
+                        self._pending -= 1
+                        if self._pending == 0:
+                            self._cond.notify_all()
+        except Exception as ex:
+            self._error = ex
+            self._stop.set()
+        finally:
+            with self._cond:
+                self._alive -= 1
+                last = self._alive == 0
+
+            if last:
+                self._end()
+
+    def get(self, directories):
+        for index, item in enumerate(directories):
+            self._push(index % self._workers, ("directory", item, None))
+
+        threads = [threading.Thread(target=self._work, args=(index,), daemon=True)
+                   for index in range(self._workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._output.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._error:
+            raise self._error
+
 class List(object):
     _directory = None
     _acl = None
+    _cache = None
+    _workers = 1
+    _inflight = 1024
+    _format = "json"
+    _previous = None
+    _changes = None
+    _algorithm = "md5"
+    _block_size = 0
 
     def __init__(self):
-        pass
+        self._digests = {}
+        self._users = {}
+        self._groups = {}
+        self._acls = {}
 
     def _compute_nt_acl(self, path):
         result = {}
         # TODO: write code for managing ACLs in Windows environment
         return result
 
-    def _compute_posix_acl(self, path):
-        # FIXME: this is a quick&dirty code, replace with a native library if possible
+    def _decode_posix_acl(self, value):
+        # Extended attribute value is a 4 bytes version header followed by
+        # (tag, permissions, id) entries, as in linux/posix_acl_xattr.h
+        if value not in self._acls:
+            user = []
+            group = []
+            owning = None
+            masked = False
+
+            for offset in range(ACL_HEADER.size, len(value) - ACL_ENTRY.size + 1, ACL_ENTRY.size):
+                tag, perm, ident = ACL_ENTRY.unpack_from(value, offset)
+                perms = "".join([
+                    "r" if perm & 4 else "-",
+                    "w" if perm & 2 else "-",
+                    "x" if perm & 1 else "-"
+                ])
+
+                if tag == ACL_USER:
+                    user.append({"uid": str(self._username(ident)), "attrs": perms})
+                elif tag == ACL_GROUP:
+                    group.append({"gid": str(self._groupname(ident)), "attrs": perms})
+                elif tag == ACL_GROUP_OBJ:
+                    owning = perms
+                elif tag == ACL_MASK:
+                    masked = True
+
+            # With a mask, the group bits of the mode are the mask, so the
+            # owning group is saved as the entry without name ("group::")
+            if masked and owning:
+                group.insert(0, {"gid": None, "attrs": owning})
+
+            if len(self._acls) >= 4096:
+                self._acls.clear()
+            self._acls[value] = {"user": user, "group": group}
+
+        return self._acls[value]
+
+    def _read_posix_acl(self, path, name):
+        try:
+            return os.getxattr(path, name)
+        except OSError:
+            # No ACL defined (or not supported by filesystem)
+            return None
+
+    def _compute_posix_acl(self, path, st):
+        if not hasattr(os, "getxattr"):
+            return self._compute_getfacl(path)
+
+        # Attributes are listed once, so files without ACLs (most of them)
+        # aren't read, and default ACLs are read only for directories
+        try:
+            names = os.listxattr(path)
+        except OSError:
+            names = []
+
+        value = None
+        if "system.posix_acl_access" in names:
+            value = self._read_posix_acl(path, "system.posix_acl_access")
+        if value:
+            result = dict(self._decode_posix_acl(value))
+        else:
+            result = {"user": [], "group": []}
+
+        if stat.S_ISDIR(st.st_mode) and "system.posix_acl_default" in names:
+            value = self._read_posix_acl(path, "system.posix_acl_default")
+            if value:
+                result["default"] = self._decode_posix_acl(value)
+
+        return result
+
+    def _compute_getfacl(self, path):
         result = {}
         name = ""
         user = []
         group = []
+        owning = None
+        masked = False
 
         try:
             p = subprocess.Popen(["getfacl", path],
@@ -153,12 +538,20 @@ class List(object):
                             "attrs": line.split(":")[2].strip("\n")
                         }
                         group.append(perms)
+                    elif line[:7] == "group::":
+                        # Owning group, its effective permissions follow
+                        owning = line.split(":")[2].split()[0]
+                    elif line[:6] == "mask::":
+                        masked = True
                     """ Useless?
                     elif line[:6] == "# file":
                         name = "/" + line[8:].strip("\n")
 
                 result["name"] = name
                 """
+                if masked and owning:
+                    group.insert(0, {"gid": None, "attrs": owning})
+
                 result["user"] = user
                 result["group"] = group
             else:
@@ -176,7 +569,27 @@ class List(object):
 
         return result
 
-    def _compute_metadata(self, path):
+    def _username(self, uid):
+        # If user isn't recognized, UID is saved
+        if uid not in self._users:
+            try:
+                self._users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._users[uid] = uid
+
+        return self._users[uid]
+
+    def _groupname(self, gid):
+        # If group isn't recognized, GID is saved
+        if gid not in self._groups:
+            try:
+                self._groups[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self._groups[gid] = gid
+
+        return self._groups[gid]
+
+    def _compute_metadata(self, path, st=None):
         attrs = {
             "type": None,
             "link": None,
@@ -195,54 +608,60 @@ class List(object):
             "os": os.name
         }
 
-        if os.path.isdir(path):
+        if st is None:
+            st = os.lstat(path)
+
+        symlink = stat.S_ISLNK(st.st_mode)
+        if symlink:
+            # Attributes of a symlink are taken from its target, if exists
+            try:
+                st = os.stat(path)
+            except OSError:
+                pass
+
+        if stat.S_ISDIR(st.st_mode):
             attrs["type"] = "directory"
-        elif os.path.islink(path):
+            attrs["hash"] = self._digests.get(path)
+        elif symlink:
             attrs["type"] = "symlink"
             attrs["link"] = os.readlink(path)
         else:
             attrs["type"] = "file"
-            attrs["size"] = os.path.getsize(path)
-            attrs["hash"] = self._hash(path)
+            attrs["size"] = st.st_size
+            attrs["hash"] = self._cached_hash(path, st)
 
-        attrs["atime"] = int(os.path.getatime(path))
-        attrs["mtime"] = int(os.path.getmtime(path))
-        attrs["ctime"] = int(os.path.getctime(path))
+        attrs["atime"] = int(st.st_atime)
+        attrs["mtime"] = int(st.st_mtime)
+        attrs["ctime"] = int(st.st_ctime)
 
         if os.name == "nt":
             if self.acl:
                 result["acl"] = self._compute_nt_acl(path)
         else:
-            mode = FileMode(os.stat(path).st_mode)
-            attrs["mode"] = mode.mode_to_octal()
-
-            # If user or group aren't recognized, UID or GID are saved
-            try:
-                attrs["user"] = pwd.getpwuid(os.stat(path).st_uid).pw_name
-            except KeyError:
-                attrs["user"] = os.stat(path).st_uid
-
-            try:
-                attrs["group"] = grp.getgrgid(os.stat(path).st_gid).gr_name
-            except KeyError:
-                attrs["group"] = os.stat(path).st_gid
+            attrs["mode"] = MODES[stat.S_IMODE(st.st_mode)]
+            attrs["user"] = self._username(st.st_uid)
+            attrs["group"] = self._groupname(st.st_gid)
 
             if self.acl:
-                result["acl"] = self._compute_posix_acl(path)
+                result["acl"] = self._compute_posix_acl(path, st)
 
         result["attrs"] = attrs
         return result
 
-    def _hash(self, path, block_size=2**20):
-        md5 = hashlib.md5()
+    def _cached_hash(self, path, st):
+        if not self._cache:
+            return self._hash(path)
 
+        digest = self._cache.lookup(st)
+        if digest is None:
+            digest = self._hash(path)
+            self._cache.store(st, digest)
+
+        return digest
+
+    def _hash(self, path):
         with open(path, "rb") as f:
-            while True:
-                data = f.read(block_size)
-                if not data:
-                    break
-                md5.update(data)
-        return md5.hexdigest()
+            return hash_file(f, self._algorithm, self._block_size)
 
     @property
     def directory(self):
@@ -271,42 +690,638 @@ class List(object):
     def acl(self):
         del self._acl
 
-    def get(self):
+    @property
+    def cache(self):
+        return self._cache
+
+    @cache.setter
+    def cache(self, value):
+        self._cache = value
+
+    @cache.deleter
+    def cache(self):
+        del self._cache
+
+    @property
+    def format(self):
+        return self._format
+
+    @format.setter
+    def format(self, value):
+        if value not in ["json", "binary"]:
+            raise ValueError("Invalid listing format")
+
+        self._format = value
+
+    @format.deleter
+    def format(self):
+        del self._format
+
+    @property
+    def previous(self):
+        return self._previous
+
+    @previous.setter
+    def previous(self, value):
+        if type(value) != dict:
+            raise ValueError("Invalid digest list")
+
+        self._previous = value
+
+    @previous.deleter
+    def previous(self):
+        del self._previous
+
+    @property
+    def changes(self):
+        return self._changes
+
+    @changes.setter
+    def changes(self, value):
+        if type(value) != list:
+            raise ValueError("Invalid change list")
+
+        self._changes = value
+
+    @changes.deleter
+    def changes(self):
+        del self._changes
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, value):
+        if value < 1:
+            raise ValueError("Invalid number of workers")
+
+        self._workers = value
+
+    @workers.deleter
+    def workers(self):
+        del self._workers
+
+    @property
+    def algorithm(self):
+        return self._algorithm
+
+    @algorithm.setter
+    def algorithm(self, value):
+        get_hasher(value)
+        self._algorithm = value
+
+    @algorithm.deleter
+    def algorithm(self):
+        del self._algorithm
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @block_size.setter
+    def block_size(self, value):
+        if value < 0:
+            raise ValueError("Invalid hash block size")
+
+        self._block_size = value
+
+    @block_size.deleter
+    def block_size(self):
+        del self._block_size
+
+    @property
+    def inflight(self):
+        return self._inflight
+
+    @inflight.setter
+    def inflight(self, value):
+        if value < 1:
+            raise ValueError("Invalid number of files in flight")
+
+        self._inflight = value
+
+    @inflight.deleter
+    def inflight(self):
+        del self._inflight
+
+    def _scan(self, path):
+        dirs = []
+        files = []
+
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        isdir = entry.is_dir()
+                    except OSError:
+                        isdir = False
+
+                    if isdir:
+                        dirs.append(entry)
+                    else:
+                        files.append(entry)
+        except OSError:
+            # Unreadable directories are skipped, as os.walk does
+            return None
+
+        return dirs, files
+
+    def _digest_entry(self, md5, name, st):
+        md5.update(DIGEST_ENTRY.pack(st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime_ns, st.st_ctime_ns))
+        md5.update(name.encode("utf-8", "surrogateescape") + b"\0")
+
+    def _compute_digests(self):
+        # Post order walk: the digest of a directory covers its own metadata,
+        # the metadata of its children and the digests of its subdirectories
+        self._digests = {}
+
         for item in self._directory:
-            for root, dirs, files in os.walk(item):
-                for directory in dirs:
-                    path = os.path.join(root, directory)
-                    result = self._compute_metadata(path)
-                    result["result"] = "ok"
-
-                    yield json.dumps(result)
-
-                for filename in files:
-                    path = os.path.join(root, filename)
-                    result = self._compute_metadata(path)
-                    result["result"] = "ok"
-
-                    yield json.dumps(result)
-                result = self._compute_metadata(root)
-                result["result"] = "ok"
-                yield json.dumps(result)
-
-def send_data(filename):
-    with open(filename, "rb") as f:
-        while True:
-            data = f.read(2**20)
+            pending = [(item, None)]
+
+            while pending:
+                root, children = pending.pop()
+
+                if children is None:
+                    scanned = self._scan(root)
+                    if scanned is None:
+                        continue
+                    dirs, files = scanned
+
+                    children = [(entry, not entry.is_symlink()) for entry in dirs]
+                    children.extend([(entry, False) for entry in files])
+                    pending.append((root, children))
+
+                    for entry, subdir in children:
+                        if subdir:
+                            pending.append((entry.path, None))
+                    continue
+
+                try:
+                    md5 = hashlib.md5()
+                    self._digest_entry(md5, "", os.lstat(root))
+
+                    for entry, subdir in sorted(children, key=lambda child: child[0].name):
+                        self._digest_entry(md5, entry.name, entry.stat(follow_symlinks=False))
+                        if subdir:
+                            # Unreadable directories are not listed, so they have no digest
+                            md5.update(self._digests.get(entry.path, "").encode("utf-8"))
+                except OSError:
+                    # Changed while scanned, it is listed again
+                    continue
+
+                self._digests[root] = md5.hexdigest()
+
+    def _unchanged(self, path):
+        if self._previous is None or path not in self._digests:
+            return False
+
+        return self._digests[path] == self._previous.get(path)
+
+    def _marker(self, path, state="unchanged"):
+        result = {"result": state, "name": path}
+
+        if self._format == "binary":
+            return result
+
+        return json.dumps(result)
+
+    def _dump(self, path, st=None):
+        result = self._compute_metadata(path, st)
+
+        if self._format == "binary":
+            # Records are encoded in output order, by the caller
+            return result
+
+        result["result"] = "ok"
+        return json.dumps(result)
+
+    def _walk(self, directories):
+        # Output has the same order of the os.walk based implementation: for
+        # every directory, its subdirectories, its files and then itself
+        for item in directories:
+            pending = [(item, None)]
+
+            while pending:
+                root, st = pending.pop()
+
+                # Content of unchanged directories is copied by the server from
+                # the previous dataset
+                if self._unchanged(root):
+                    yield self._dump(root, st)
+                    yield self._marker(root)
+                    continue
+
+                scanned = self._scan(root)
+                if scanned is None:
+                    continue
+                dirs, files = scanned
+
+                for entry in dirs + files:
+                    yield self._dump(entry.path, entry.stat(follow_symlinks=False))
+                yield self._dump(root, st)
+
+                for entry in reversed(dirs):
+                    if not entry.is_symlink():
+                        pending.append((entry.path, entry.stat(follow_symlinks=False)))
+
+    def _get_changes(self):
+        trees = set([path for path, tree in self._changes if tree])
+
+        for path, tree in sorted(self._changes):
+            # Paths below a changed tree are listed with it
+            parent = os.path.dirname(path)
+            while parent != os.path.dirname(parent) and parent not in trees:
+                parent = os.path.dirname(parent)
+            if parent in trees and parent != path:
+                continue
+
+            yield self._marker(path, "tree" if tree else "changed")
+
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # Removed
+                continue
+
+            if tree and stat.S_ISDIR(st.st_mode):
+                yield from self._walk([path])
+            else:
+                yield self._dump(path, st)
+
+    def get(self):
+        if self._changes is not None:
+            yield from self._get_changes()
+            return
+
+        if self._previous is not None:
+            self._compute_digests()
+
+        if self._workers > 1:
+            # NOTE: with parallel walk, the order of entries is not defined
+            yield from ParallelWalk(self, self._workers, self._inflight).get(self._directory)
+            return
+
+        yield from self._walk(self._directory)
+
+def read_data(f, block_size=2**20):
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        yield data
+
+def get_extents(f, offset=0):
+    # Data ranges of a file with holes, from the offset. None if the file
+    # is dense or the file system can't tell where holes are
+    fd = f.fileno()
+    st = os.fstat(fd)
+    if not hasattr(os, "SEEK_DATA") or st.st_blocks * 512 >= st.st_size:
+        return None
+
+    extents = []
+    position = offset
+    try:
+        while position < st.st_size:
+            try:
+                start = os.lseek(fd, position, os.SEEK_DATA)
+            except OSError as err:
+                if err.errno == errno.ENXIO:
+                    break
+                raise
+
+            position = min(os.lseek(fd, start, os.SEEK_HOLE), st.st_size)
+            extents.append((start, position - start))
+    except OSError:
+        return None
+    finally:
+        os.lseek(fd, offset, os.SEEK_SET)
+
+    return st.st_size, extents
+
+def read_extents(f, extents, block_size=2**20):
+    for offset, length in extents:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(length, block_size))
             if not data:
-                break
+                return
             yield data
+            length -= len(data)
+
+def get_hasher(algorithm="md5"):
+    name, _, size = (algorithm or "md5").partition("-")
+
+    if name not in HASHES:
+        raise ValueError("Unknown hash algorithm " + algorithm)
+    elif name in ["blake2b", "blake2s"]:
+        limit = 64 if name == "blake2b" else 32
+        if size and not (size.isdigit() and 1 <= int(size) <= limit):
+            raise ValueError("Invalid digest size for " + algorithm)
+        return getattr(hashlib, name)(digest_size=int(size or limit))
+    elif size:
+        raise ValueError("Digest size not supported by " + name)
+
+    return hashlib.new(name)
+
+# Read buffers of the hashing threads, allocated once per thread
+_buffers = threading.local()
+
+def hash_file(f, algorithm="md5", block_size=0):
+    hasher = get_hasher(algorithm)
+
+    if not block_size and hasattr(hashlib, "file_digest"):
+        return hashlib.file_digest(f, lambda: hasher).hexdigest()
+
+    # Blocks are read into a reused buffer, hashing releases the GIL
+    block_size = block_size or 2**20
+    if getattr(_buffers, "data", None) is None or len(_buffers.data) != block_size:
+        _buffers.data = memoryview(bytearray(block_size))
+
+    view = _buffers.data
+    while True:
+        count = f.readinto(view)
+        if not count:
+            break
+        hasher.update(view[:count])
+
+    return hasher.hexdigest()
+
+def digest_data(f, size, algorithm="md5", block_size=2**20):
+    hasher = get_hasher(algorithm)
+
+    while size > 0:
+        data = f.read(min(size, block_size))
+        if not data:
+            return None
+        hasher.update(data)
+        size -= len(data)
+
+    return hasher.hexdigest()
+
+def get_compressor(codec, level=None):
+    if codec == "zlib":
+        return zlib.compressobj(6 if level is None else level)
+    elif codec == "lzma":
+        return lzma.LZMACompressor(preset=level)
+    elif codec == "bz2":
+        return bz2.BZ2Compressor(9 if level is None else level)
+    else:
+        return None
+
+def check_level(codec, level):
+    if level is not None and codec in LEVELS and level not in LEVELS[codec]:
+        raise ValueError("Level " + str(level) + " not supported by " + codec)
+
+def compress_data(data, codec=None, level=None):
+    compressor = get_compressor(codec, level)
+    if not compressor:
+        yield from data
+        return
+
+    for chunk in data:
+        result = compressor.compress(chunk)
+        if result:
+            yield result
+
+    result = compressor.flush()
+    if result:
+        yield result
+
+def get_decompressor(codec):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    elif codec == "lzma":
+        return lzma.LZMADecompressor()
+    elif codec == "bz2":
+        return bz2.BZ2Decompressor()
+    else:
+        return None
+
+def decompress_data(data, codec=None):
+    decompressor = get_decompressor(codec)
+    if not decompressor:
+        yield from data
+        return
+
+    # Output is produced in bounded chunks, because highly compressible data
+    # can expand a lot
+    for chunk in data:
+        if hasattr(decompressor, "unconsumed_tail"):
+            while chunk:
+                result = decompressor.decompress(chunk, 2**20)
+                chunk = decompressor.unconsumed_tail
+                if result:
+                    yield result
+        else:
+            result = decompressor.decompress(chunk, 2**20)
+            while result:
+                yield result
+                if decompressor.eof or decompressor.needs_input:
+                    break
+                result = decompressor.decompress(b"", 2**20)
+
+    if not decompressor.eof:
+        raise EOFError("Compressed data ended before the end of the stream")
+
+def restore_data(data, filename, codec=None):
+    # Content is written aside and replaces the file only when complete
+    temp = filename + ".restore"
+    written = 0
+
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    try:
+        with open(temp, "wb") as destfile:
+            for chunk in decompress_data(data, codec):
+                destfile.write(chunk)
+                written += len(chunk)
+        os.replace(temp, filename)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+    return written
+
+def _owner_id(name, lookup):
+    # Owners unknown here are restored by their saved identifier
+    if name is None:
+        return -1
+
+    try:
+        return lookup(name)
+    except KeyError:
+        return int(name) if name.isdigit() else -1
+
+def _acl_perms(value):
+    return (4 if "r" in value else 0) | (2 if "w" in value else 0) | (1 if "x" in value else 0)
+
+def encode_posix_acl(mode, acl):
+    # Entries are sorted by tag and identifier, as the kernel requires, and
+    # unique (directories can be listed twice). The group bits of the saved
+    # mode are the mask of the original ACL, the owning group has its own
+    # entry without name (the mask in ACLs saved before it)
+    owning = (mode >> 3) & 7
+    entries = [(ACL_USER_OBJ, (mode >> 6) & 7, ACL_UNDEFINED_ID),
+               (ACL_MASK, (mode >> 3) & 7, ACL_UNDEFINED_ID),
+               (ACL_OTHER, mode & 7, ACL_UNDEFINED_ID)]
 
-def receive_data(conn, filename):
+    for item in acl.get("user", []):
+        ident = _owner_id(item["uid"], lambda name: pwd.getpwnam(name).pw_uid)
+        if ident >= 0:
+            entries.append((ACL_USER, _acl_perms(item["attrs"]), ident))
+    for item in acl.get("group", []):
+        if item["gid"] is None:
+            owning = _acl_perms(item["attrs"])
+            continue
+        ident = _owner_id(item["gid"], lambda name: grp.getgrnam(name).gr_gid)
+        if ident >= 0:
+            entries.append((ACL_GROUP, _acl_perms(item["attrs"]), ident))
+    entries.append((ACL_GROUP_OBJ, owning, ACL_UNDEFINED_ID))
+
+    return ACL_HEADER.pack(ACL_VERSION) + b"".join([ACL_ENTRY.pack(*entry) for entry in sorted(set(entries))])
+
+def set_metadata(path, attrs, acl=None):
+    symlink = attrs["type"] == "symlink"
+    mode = int(attrs["mode"], 8) if attrs.get("mode") else None
+
+    if os.name == "posix":
+        uid = _owner_id(attrs.get("user"), lambda name: pwd.getpwnam(name).pw_uid)
+        gid = _owner_id(attrs.get("group"), lambda name: grp.getgrnam(name).gr_gid)
+        try:
+            os.chown(path, uid, gid, follow_symlinks=not symlink)
+        except PermissionError:
+            # Only root can give files away, they are kept by this user
+            pass
+
+        # Base entries of the default ACL are not saved, they are rebuilt
+        # from the mode of the directory like the access ones
+        xattrs = []
+        if acl and mode is not None and not symlink:
+            if acl.get("user") or acl.get("group"):
+                xattrs.append(("system.posix_acl_access", acl))
+            default = acl.get("default") or {}
+            if attrs["type"] == "directory" and (default.get("user") or default.get("group")):
+                xattrs.append(("system.posix_acl_default", default))
+
+        for name, entries in xattrs:
+            try:
+                os.setxattr(path, name, encode_posix_acl(mode, entries))
+            except OSError as err:
+                # ACLs not supported by filesystem
+                if err.errno not in [errno.ENOTSUP, errno.EOPNOTSUPP]:
+                    raise
+
+    # Mode is set after owner and ACL, which both can change it
+    if mode is not None and not symlink:
+        os.chmod(path, mode)
+
+    if attrs.get("mtime") is not None:
+        if not symlink or os.utime in os.supports_follow_symlinks:
+            os.utime(path, (attrs["mtime"], attrs["mtime"]), follow_symlinks=not symlink)
+
+def receive_data(conn, filename, block_size=2**20):
     # TODO: write code for receive data
+    buffer = memoryview(bytearray(block_size))
+
     with open(filename, "wb") as destfile:
         while True:
-            data = conn.recv(2048)
-            if not data:
+            count = conn.recv_into(buffer)
+            if not count:
+                break
+            destfile.write(buffer[:count])
+
+def delta_data(f, signatures, block_size, budget=2**22):
+    # Rolling weak checksum is the Adler-32 of the window, so it can be
+    # compared with the signatures computed by server with zlib.adler32
+    buf = bytearray()
+    pos = 0
+    eof = False
+    rolling = None
+    literal = bytearray()
+    copy = None
+    misses = 0
+    skipped = 0
+
+    while True:
+        if len(buf) - pos <= block_size and not eof:
+            del buf[:pos]
+            pos = 0
+            data = f.read(2**20)
+            if data:
+                buf += data
+            else:
+                eof = True
+
+        if len(buf) - pos < block_size:
+            if eof:
                 break
-            destfile.write(data)
+            continue
+
+        if rolling is None:
+            weak = zlib.adler32(buf[pos:pos + block_size])
+            a = weak & 0xffff
+            b = weak >> 16
+            rolling = True
+
+        blocks = signatures.get((b << 16) | a)
+        if blocks:
+            index = blocks.get(hashlib.md5(buf[pos:pos + block_size]).digest())
+            if index is not None:
+                if literal:
+                    yield b"L" + literal
+                    literal = bytearray()
+
+                if copy and copy[0] + copy[1] == index:
+                    copy[1] += 1
+                else:
+                    if copy:
+                        yield b"C" + DELTA_COPY.pack(*copy)
+                    copy = [index, 1]
+
+                pos += block_size
+                rolling = None
+                misses = 0
+                continue
+
+        if copy:
+            yield b"C" + DELTA_COPY.pack(*copy)
+            copy = None
+
+        if misses >= 2 * block_size or budget <= 0:
+            # Window is rolled byte by byte only for two blocks after a match
+            # (and again every 16 blocks) within the budget of the file,
+            # otherwise it advances by whole blocks, checksummed by zlib
+            literal += buf[pos:pos + block_size]
+            pos += block_size
+            rolling = None
+
+            skipped += 1
+            if skipped >= 16:
+                misses = 0
+                skipped = 0
+        else:
+            out = buf[pos]
+            literal.append(out)
+            pos += 1
+            misses += 1
+            budget -= 1
+
+            if len(buf) - pos >= block_size:
+                a = (a - out + buf[pos + block_size - 1]) % 65521
+                b = (b - block_size * out + a - 1) % 65521
+            else:
+                rolling = None
+
+        if len(literal) >= 2**20:
+            yield b"L" + literal
+            literal = bytearray()
+
+    if copy:
+        yield b"C" + DELTA_COPY.pack(*copy)
+
+    literal += buf[pos:]
+    if literal:
+        yield b"L" + literal
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2012 Enrico Bianchi (enrico.bianchi@gmail.com)
+Project       Syncropy-ng
+Description   A backup system (client module)
+License       GPL version 2 (see GPL.txt for details)
+"""
+
+__author__ = "enrico"
+
+import json
+import os
+import ssl
+import struct
+
+"""
+NOTE:
+
+Session:
+    A long-lived connection opened with the "session" system command. After
+    the acknowledge, every message is a frame
+
+Frame:
+    A 4 bytes big endian length followed by the payload. A response is a
+    JSON status frame, zero or more data frames and an empty frame which
+    closes it
+
+Listing:
+    With the binary format, the client sends a JSON line announcing it and
+    then a stream of records. Every record is a 4 bytes length, a fixed
+    header (shared name prefix, type, os, size, atime, mtime, ctime) and
+    the variable fields (name suffix, hash, mode, user, group, link, acl),
+    each one with a 4 bytes length. An empty record closes the stream
+
+Digests:
+    When asked, the client announces them in the listing header and the
+    server replies with the directory digests of the previous dataset, as
+    frames of JSON objects. Content of a directory with the same digest is
+    sent as a single "unchanged" entry, after the directory itself
+
+Changes:
+    When the list command has the token of a previous listing and the
+    client journal covers it, only the changed paths are sent: a "changed"
+    entry followed by the path itself, or a "tree" entry followed by the
+    whole tree, if it still exists. The header has the new token
+
+Hash:
+    The list command has the content hash algorithms accepted by the server
+    in order of preference (as "blake2b-32", with the digest size in bytes
+    for BLAKE2). The client hashes files with the first one it supports and
+    announces it in the header, without header the algorithm is MD5
+
+Sparse:
+    When the get command asks for it and the file has holes, the response
+    has the file size and is followed by the data extents (as frames of 8
+    bytes offset and length pairs, closed by an empty frame). Data frames
+    carry only the content of the extents, holes are zeros
+
+Batch:
+    The getbatch command has a list of files (name and codec). Its response
+    is followed, for every file, by a header message (name, result, codec
+    and size) and, if the file can be read, by its data frames closed by
+    an empty frame. An empty frame closes the batch
+
+Restore:
+    The put command has the client path, the codec and the metadata of an
+    entry (attrs and acl, as in the listing). A file is followed by its
+    data frames closed by an empty frame. Server doesn't wait the response
+    of a put command before sending the next one, the client answers every
+    one of them in order
+
+"""
+
+HEADER = struct.Struct(">I")
+EXTENT = struct.Struct(">QQ")
+MAX_FRAME = 2**26
+
+LIST_LENGTH = struct.Struct(">I")
+LIST_HEADER = struct.Struct(">HBBqqqq")
+LIST_NONE = 0xFFFFFFFF
+LIST_TYPES = ["file", "directory", "symlink", "unchanged", "changed", "tree"]
+LIST_MARKERS = ["unchanged", "changed", "tree"]
+LIST_SYSTEMS = ["posix", "nt"]
+
+def _recv_exact(conn, size):
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = conn.recv(min(size - len(data), 2**20))
+        if not chunk:
+            if data:
+                raise ConnectionError("Connection closed while reading a frame")
+            return None
+        data += chunk
+
+    return bytes(data)
+
+def recv_frame(conn):
+    header = _recv_exact(conn, HEADER.size)
+    if header is None:
+        return None
+
+    size = HEADER.unpack(header)[0]
+    if size > MAX_FRAME:
+        raise ValueError("Frame too large: " + str(size))
+    elif size == 0:
+        return b""
+
+    data = _recv_exact(conn, size)
+    if data is None:
+        raise ConnectionError("Connection closed while reading a frame")
+
+    return data
+
+def send_frame(conn, data=b""):
+    if len(data) < 2**16:
+        conn.sendall(HEADER.pack(len(data)) + data)
+    else:
+        conn.sendall(HEADER.pack(len(data)))
+        conn.sendall(data)
+
+def _zerocopy(conn):
+    if not isinstance(conn, ssl.SSLSocket):
+        return True
+
+    # TLS records are built by the kernel only if the connection was
+    # offloaded to it (kTLS), otherwise sendfile would copy in small blocks
+    sslobj = getattr(conn, "_sslobj", None)
+    return bool(sslobj and hasattr(sslobj, "uses_ktls_for_send") and sslobj.uses_ktls_for_send())
+
+def send_file(conn, f, offset=0, block_size=2**23, extents=None):
+    # Data frames of the file are sent by the kernel from the page cache,
+    # or through a single reusable buffer
+    if extents is None:
+        extents = [(offset, os.fstat(f.fileno()).st_size - offset)]
+
+    zerocopy = _zerocopy(conn)
+    if not zerocopy:
+        view = memoryview(bytearray(min(block_size, max([length for _, length in extents] + [1]))))
+
+    for offset, length in extents:
+        end = offset + length
+
+        while offset < end:
+            count = min(block_size, end - offset)
+            conn.sendall(HEADER.pack(count))
+
+            if zerocopy:
+                sent = conn.sendfile(f, offset, count)
+            else:
+                f.seek(offset)
+                sent = f.readinto(view[:count])
+                conn.sendall(view[:sent])
+
+            if sent < count:
+                # File is truncated while sending, the frame is filled anyway
+                # and the hash tells the server that the file is changed
+                conn.sendall(bytes(count - sent))
+                send_frame(conn)
+                return
+            offset += count
+
+    send_frame(conn)
+
+def send_extents(conn, extents, size=4096):
+    for index in range(0, len(extents), size):
+        send_frame(conn, b"".join([EXTENT.pack(offset, length) for offset, length in extents[index:index + size]]))
+
+    send_frame(conn)
+
+def iter_frames(conn):
+    while True:
+        data = recv_frame(conn)
+        if data is None:
+            raise ConnectionError("Connection closed before the end of the response")
+        elif not data:
+            break
+        yield data
+
+def recv_message(conn):
+    data = recv_frame(conn)
+    if data is None:
+        return None
+
+    return json.loads(data.decode("utf-8"))
+
+def send_message(conn, message):
+    send_frame(conn, json.dumps(message).encode("utf-8"))
+
+def send_response(conn, message):
+    send_message(conn, message)
+    send_frame(conn)
+
+def recv_digests(conn):
+    result = {}
+
+    for data in iter_frames(conn):
+        result.update(json.loads(data.decode("utf-8")))
+
+    return result
+
+def _list_field(value):
+    if value is None:
+        return LIST_LENGTH.pack(LIST_NONE)
+    elif not isinstance(value, bytes):
+        value = str(value).encode("utf-8", "surrogateescape")
+
+    return LIST_LENGTH.pack(len(value)) + value
+
+class ListEncoder(object):
+    def __init__(self, size=2**18):
+        self._size = size
+        self._buffer = bytearray()
+        self._previous = b""
+
+    def add(self, item):
+        name = item["name"].encode("utf-8", "surrogateescape")
+
+        # Entries of the same directory share most of their name
+        shared = min(len(os.path.commonprefix([self._previous, name])), 0xFFFF)
+        self._previous = name
+
+        if item.get("result") in LIST_MARKERS:
+            payload = b"".join([LIST_HEADER.pack(shared, LIST_TYPES.index(item["result"]), 0, -1, 0, 0, 0),
+                                _list_field(name[shared:])] +
+                               [_list_field(None)] * 6)
+            return self._append(payload)
+
+        attrs = item["attrs"]
+        if attrs["hash"]:
+            hashed = bytes.fromhex(attrs["hash"])
+        else:
+            hashed = None
+
+        if "acl" in item:
+            acl = json.dumps(item["acl"])
+        else:
+            acl = None
+
+        payload = b"".join([
+            LIST_HEADER.pack(shared, LIST_TYPES.index(attrs["type"]), LIST_SYSTEMS.index(item["os"]),
+                             -1 if attrs["size"] is None else attrs["size"],
+                             attrs["atime"], attrs["mtime"], attrs["ctime"]),
+            _list_field(name[shared:]),
+            _list_field(hashed),
+            _list_field(attrs["mode"]),
+            _list_field(attrs["user"]),
+            _list_field(attrs["group"]),
+            _list_field(attrs["link"]),
+            _list_field(acl)
+        ])
+
+        return self._append(payload)
+
+    def _append(self, payload):
+        self._buffer += LIST_LENGTH.pack(len(payload))
+        self._buffer += payload
+
+        if len(self._buffer) >= self._size:
+            return self.flush()
+        else:
+            return b""
+
+    def flush(self, end=False):
+        if end:
+            self._buffer += LIST_LENGTH.pack(0)
+
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+
+        return data
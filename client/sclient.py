@@ -14,12 +14,17 @@ import argparse
 import configparser
 import json
 import logging
+import lzma
+import os
 import socket
 import ssl
 import subprocess
 import sys
+import threading
+import zlib
 
 import files
+import protocol
 
 
 def init_args():
@@ -27,12 +32,27 @@ def init_args():
     args.add_argument("-p", "--port", required=True, metavar="<port>", help="Port which listen")
     args.add_argument("-l", "--listen", metavar="<address>", help="Address to listen")
     args.add_argument("-S", "--ssl", metavar="<file>", help="Enable SSL support")
+    args.add_argument("-C", "--cache", metavar="<file>", help="Use the specified file as hash cache")
+    args.add_argument("--cache-size", metavar="<entries>", type=int, default=1000000,
+                      help="Maximum number of entries in hash cache")
+    args.add_argument("-t", "--connections", metavar="<number>", type=int, default=1,
+                      help="Number of connections served at the same time")
+    args.add_argument("-w", "--workers", metavar="<number>", type=int, default=1,
+                      help="Number of threads which walk and hash files when listing")
+    args.add_argument("--hash-block-size", metavar="<bytes>", type=int, default=0,
+                      help="Size of the blocks read when hashing files (default automatic)")
+    args.add_argument("--inflight", metavar="<number>", type=int, default=1024,
+                      help="Maximum number of files in flight when listing with more threads")
+    args.add_argument("-W", "--watch", metavar="<directory>", action="append",
+                      help="Record changes of the directory into the journal (can be repeated)")
+    args.add_argument("-J", "--journal", metavar="<file>", default="journal.db",
+                      help="Use the specified file as change journal")
 
     return args
 
 
 def get_socket(port, address=None, sslparams=None):
-    if sslparams:
+    if sslparams and sslparams["enabled"]:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
@@ -42,7 +62,10 @@ def get_socket(port, address=None, sslparams=None):
 
         context.load_verify_locations(cafile=sslparams["pem"])
         context.verify_mode = ssl.CERT_REQUIRED
-        s = context.wrap_socket(sock, server_side=True)
+        # Files are encrypted by the kernel, where supported, and sent with sendfile
+        context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
+        # Handshake is done by the thread which serves the connection
+        s = context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
     else:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -89,7 +112,7 @@ def exec_command(cmd):
         return (json.dumps({"result": "ko", "error": str(e)}) + "\n").encode("utf-8")
 
 
-def parse(command, conn):
+def parse(command, conn, params):
     try:
         cmd = json.loads(command.decode('utf-8'))
     except ValueError:
@@ -99,10 +122,12 @@ def parse(command, conn):
     result = True
     try:
         if cmd["context"] == "file":
-            parsefile(cmd, conn)
+            parsefile(cmd, conn, params)
         elif cmd["context"] == "system":
             if cmd["command"]["name"] == "exec":
                 conn.send(exec_command(cmd["command"]["value"]))
+            elif cmd["command"]["name"] == "session":
+                session(conn)
             elif cmd["command"]["name"] == "exit":
                 result = False
         else:
@@ -114,9 +139,9 @@ def parse(command, conn):
     return result
 
 
-def parsefile(cmd, conn):
+def parsefile(cmd, conn, params):
     if cmd["command"]["name"] == "list":
-        listfile(cmd, conn)
+        listfile(cmd, conn, params)
     elif cmd["command"]["name"] == "get":
         getfile(cmd, conn)
     elif cmd["command"]["name"] == "put":
@@ -125,57 +150,354 @@ def parsefile(cmd, conn):
         conn.send((json.dumps({"result": "ko", "message": "Command not found"}) + "\n").encode("utf-8"))
 
 
-def listfile(cmd, conn):
+def listfile(cmd, conn, params):
+    cache = None
+
     try:
         res = files.List()
         res.directory = cmd["command"]["directory"]
         res.acl = cmd["command"]["acl"]
+        res.workers = params.get("workers", 1)
+        res.inflight = params.get("inflight", 1024)
+        res.block_size = params.get("block_size", 0)
 
-        for item in res.get():
-            conn.send((item + "\n").encode("utf-8"))
+        # First algorithm offered by the server which is supported here
+        for item in cmd["command"].get("algorithms", []):
+            try:
+                res.algorithm = item
+                break
+            except ValueError:
+                continue
+
+        if params.get("cache"):
+            cache = files.HashCache(params["cache"], params["cache_size"], res.algorithm)
+            res.cache = cache
+
+        # Server lists the formats it understands, JSON lines are the fallback
+        if "binary" in cmd["command"].get("formats", []):
+            res.format = "binary"
+
+        # With a valid token of the journal, only the changes since it are listed
+        journal = params.get("journal")
+        token = None
+        changes = None
+        if journal and "formats" in cmd["command"]:
+            token = journal.token()
+            if cmd["command"].get("since"):
+                changes = journal.changes(cmd["command"]["since"], token, res.directory)
+
+        digests = cmd["command"].get("digests", False) and changes is None
+        if res.format == "binary" or digests or token or res.algorithm != "md5":
+            header = {"result": "ok", "format": res.format, "algorithm": res.algorithm}
+            if digests:
+                header["digests"] = True
+            if token:
+                header["token"] = token
+            if changes is not None:
+                header["changes"] = True
+                res.changes = changes
+            conn.sendall((json.dumps(header) + "\n").encode("utf-8"))
+
+            if digests:
+                res.previous = protocol.recv_digests(conn)
+
+        if res.format == "binary":
+            encoder = protocol.ListEncoder()
+            for item in res.get():
+                data = encoder.add(item)
+                if data:
+                    conn.sendall(data)
+            conn.sendall(encoder.flush(end=True))
+        else:
+            for item in res.get():
+                conn.send((item + "\n").encode("utf-8"))
     except ValueError as ex:
         conn.send((json.dumps({"result": "ko", "message": str(ex)}) + "\n").encode("utf-8"))
+    finally:
+        if cache:
+            cache.close()
+            logging.info("Hash cache: {0} hits, {1} misses".format(cache.hits, cache.misses))
 
 
 def getfile(cmd, conn):
-    for data in files.send_data(cmd["command"]["filename"]):
-        conn.send(data)
+    with open(cmd["command"]["filename"], "rb") as source:
+        conn.sendfile(source)
 
 
 def putfile(cmd, conn):
     files.receive_data(conn, cmd["command"]["filename"])
 
 
-def serve(sock):
-    sock.listen(1)
+def session(conn):
+    protocol.send_message(conn, {"result": "ok", "message": "Session started"})
+
+    while True:
+        data = protocol.recv_frame(conn)
+        if data is None:
+            break
 
-    execute = True
-    while execute:
         try:
-            conn, addr = sock.accept()
-            data = conn.recv(4096)
-            execute = parse(data, conn)
-        except UnicodeDecodeError:
-            pass
-        except ssl.SSLError as err:
-            print("SSL error: {0}".format(err))
-        except OSError as err:
-            print("Operating system error({0})".format(err))
-        finally:
+            cmd = json.loads(data.decode("utf-8"))
+        except ValueError:
+            protocol.send_response(conn, {"result": "ko", "message": "Malformed command"})
+            continue
+
+        try:
+            if cmd["context"] == "file":
+                sessionfile(cmd, conn)
+            elif cmd["context"] == "system" and cmd["command"]["name"] == "exit":
+                break
+            else:
+                protocol.send_response(conn, {"result": "ko", "message": "Context not found"})
+        except KeyError:
+            logging.exception("KeyError Traceback and data: " + data.decode("utf-8"))
+            protocol.send_response(conn, {"result": "ko", "message": "Malformed command"})
+
+
+def sessionfile(cmd, conn):
+    if cmd["command"]["name"] == "get":
+        getframes(cmd, conn)
+    elif cmd["command"]["name"] == "getbatch":
+        getbatchframes(cmd, conn)
+    elif cmd["command"]["name"] == "delta":
+        deltaframes(cmd, conn)
+    elif cmd["command"]["name"] == "put":
+        putframes(cmd, conn)
+    else:
+        protocol.send_response(conn, {"result": "ko", "message": "Command not found"})
+
+
+def get_codec(options):
+    codec = (options or {}).get("codec", "none")
+
+    return codec if codec in files.CODECS else "none"
+
+
+def sendframes(conn, source, codec, level, offset=0, extents=None):
+    if codec == "none":
+        protocol.send_file(conn, source, offset, extents=extents)
+        return
+
+    chunks = files.read_extents(source, extents) if extents is not None else files.read_data(source)
+    for data in files.compress_data(chunks, codec, level):
+        protocol.send_frame(conn, data)
+    protocol.send_frame(conn)
+
+
+def getframes(cmd, conn):
+    options = cmd["command"].get("compress") or {}
+    codec = get_codec(options)
+
+    # Compression can't fail after the header, frames would be interrupted
+    try:
+        files.check_level(codec, options.get("level"))
+        source = open(cmd["command"]["filename"], "rb")
+    except (OSError, ValueError) as err:
+        protocol.send_response(conn, {"result": "ko", "message": str(err)})
+        return
+
+    with source:
+        # Transfer is resumed only if data already received matches the file
+        offset = int(cmd["command"].get("offset", 0))
+        if offset:
             try:
-                conn.shutdown(socket.SHUT_RDWR)
-            except:
+                digest = files.digest_data(source, offset, cmd["command"].get("algorithm", "md5"))
+            except ValueError:
+                digest = None
+
+            if digest is None or digest != cmd["command"].get("digest"):
+                offset = 0
+        source.seek(offset)
+
+        # Holes of sparse files are not sent
+        sparse = files.get_extents(source, offset) if cmd["command"].get("sparse") else None
+        if sparse:
+            size, extents = sparse
+            protocol.send_message(conn, {"result": "ok", "codec": codec, "offset": offset, "size": size})
+            protocol.send_extents(conn, extents)
+        else:
+            extents = None
+            protocol.send_message(conn, {"result": "ok", "codec": codec, "offset": offset})
+
+        sendframes(conn, source, codec, options.get("level"), offset, extents)
+
+
+def getbatchframes(cmd, conn):
+    protocol.send_message(conn, {"result": "ok"})
+
+    # Every file is a header followed by its data frames, a file which
+    # can't be read has only the header
+    for item in cmd["command"]["files"]:
+        options = item.get("compress") or {}
+        codec = get_codec(options)
+
+        try:
+            files.check_level(codec, options.get("level"))
+            source = open(item["filename"], "rb")
+        except (OSError, ValueError) as err:
+            protocol.send_message(conn, {"name": item["filename"], "result": "ko", "message": str(err)})
+            continue
+
+        with source:
+            protocol.send_message(conn, {"name": item["filename"], "result": "ok", "codec": codec,
+                                         "size": os.fstat(source.fileno()).st_size})
+            sendframes(conn, source, codec, options.get("level"))
+
+    protocol.send_frame(conn)
+
+
+def deltaframes(cmd, conn):
+    # Block signatures of the previous copy follow the command
+    signatures = {}
+    index = 0
+    for data in protocol.iter_frames(conn):
+        for weak, strong in files.DELTA_SIGNATURE.iter_unpack(data):
+            signatures.setdefault(weak, {}).setdefault(strong, index)
+            index += 1
+
+    block_size = int(cmd["command"]["blocksize"])
+    if block_size < 1 or block_size > 2**24:
+        protocol.send_response(conn, {"result": "ko", "message": "Invalid block size"})
+        return
+
+    try:
+        source = open(cmd["command"]["filename"], "rb")
+    except OSError as err:
+        protocol.send_response(conn, {"result": "ko", "message": str(err)})
+        return
+
+    with source:
+        protocol.send_message(conn, {"result": "ok"})
+        for data in files.delta_data(source, signatures, block_size):
+            protocol.send_frame(conn, data)
+        protocol.send_frame(conn)
+
+
+def putframes(cmd, conn):
+    filename = cmd["command"]["filename"]
+    attrs = cmd["command"]["attrs"]
+    written = 0
+    data = None
+
+    try:
+        if attrs["type"] == "file":
+            data = protocol.iter_frames(conn)
+            written = files.restore_data(data, filename, cmd["command"].get("codec"))
+        elif attrs["type"] == "directory":
+            os.makedirs(filename, exist_ok=True)
+        elif attrs["type"] == "symlink":
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            if os.path.lexists(filename):
+                os.remove(filename)
+            os.symlink(attrs["link"], filename)
+
+        files.set_metadata(filename, attrs, cmd["command"].get("acl"))
+    except (OSError, ValueError, EOFError, lzma.LZMAError, zlib.error) as err:
+        # Rest of the content is read anyway, the next command follows it
+        if data is not None:
+            for _ in data:
                 pass
+        protocol.send_response(conn, {"result": "ko", "name": filename, "message": str(err)})
+        return
+
+    protocol.send_response(conn, {"result": "ok", "name": filename, "size": written})
+
+
+def handle(conn, params, stop, slots):
+    try:
+        conn.settimeout(None)
+        if isinstance(conn, ssl.SSLSocket):
+            conn.do_handshake()
+
+        data = conn.recv(4096)
+        if not parse(data, conn, params):
+            stop.set()
+    except UnicodeDecodeError:
+        pass
+    except ssl.SSLError as err:
+        print("SSL error: {0}".format(err))
+    except OSError as err:
+        print("Operating system error({0})".format(err))
+    finally:
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+
+        try:
+            conn.close()
+        except:
+            pass
+
+        slots.release()
+
+
+def serve(sock, params=None, stop=None):
+    if params is None:
+        params = {}
+
+    if stop is None:
+        stop = threading.Event()
+
+    # Every connection is served by its own thread, up to the configured
+    # number of concurrent connections
+    workers = params.get("connections", 1)
+    slots = threading.BoundedSemaphore(workers)
+    threads = []
+
+    sock.listen(workers)
+    sock.settimeout(1)
+
+    try:
+        while not stop.is_set():
+            if not slots.acquire(timeout=1):
+                continue
 
             try:
-                conn.close()
-            except:
-                pass
+                conn, addr = sock.accept()
+            except socket.timeout:
+                slots.release()
+                continue
+            except OSError as err:
+                slots.release()
+                if stop.is_set() or sock.fileno() == -1:
+                    break
+                print("Operating system error({0})".format(err))
+                continue
+
+            thread = threading.Thread(target=handle, args=(conn, params, stop, slots), daemon=True)
+            thread.start()
+
+            threads = [item for item in threads if item.is_alive()]
+            threads.append(thread)
+    finally:
+        # Connections in progress are completed before exiting
+        stop.set()
+        for thread in threads:
+            thread.join()
 
 
 def go(sysargs):
     args = init_args().parse_args(sysargs)
 
+    params = {
+        "cache": args.cache,
+        "cache_size": args.cache_size,
+        "connections": args.connections,
+        "workers": args.workers,
+        "inflight": args.inflight,
+        "block_size": args.hash_block_size,
+        "journal": None
+    }
+
+    watcher = None
+    if args.watch:
+        import watch
+
+        params["journal"] = watch.Journal(args.journal, args.watch)
+        watcher = watch.Watcher(params["journal"], args.watch)
+        watcher.start()
+
     if args.ssl:
         cfg = configparser.ConfigParser()
         cfg.read(args.ssl)
@@ -187,13 +509,17 @@ def go(sysargs):
         }
 
         sock = get_socket(args.port, args.listen, sslparams)
-        serve(sock)
+        serve(sock, params)
     else:
         sock = get_socket(args.port, args.listen)
-        serve(sock)
+        serve(sock, params)
 
         sock.close()
 
+    if watcher:
+        watcher.stop()
+        params["journal"].close()
+
 
 if __name__ == "__main__":
     #import tracemalloc
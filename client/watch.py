@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2012 Enrico Bianchi (enrico.bianchi@gmail.com)
+Project       Syncropy-ng
+Description   A backup system (client module)
+License       GPL version 2 (see GPL.txt for details)
+"""
+
+__author__ = "enrico"
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+
+"""
+NOTE:
+
+Journal:
+    Paths changed under the watched roots, each one with the sequence of its
+    last change. A token is the epoch of the journal and a sequence: changes
+    since a token are valid only in the same epoch, which is renewed when
+    the watcher starts or events are lost
+
+Tree:
+    A change which covers a path and everything below it (a directory
+    created, removed or moved)
+
+"""
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT = struct.Struct("iIII")
+
+class Inotify(object):
+    _fd = None
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def read(self, timeout=1):
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+
+        try:
+            data = os.read(self._fd, 2**16)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class Journal(object):
+    _conn = None
+    _roots = None
+    _epoch = None
+    _seq = None
+
+    def __init__(self, path, roots):
+        self._roots = [os.path.abspath(item) for item in roots]
+        self._lock = threading.Lock()
+        self._complete = True
+
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute(" ".join(["CREATE TABLE IF NOT EXISTS changes (",
+                                     "path TEXT PRIMARY KEY, seq INTEGER, tree INTEGER)"]))
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_changes_1 ON changes(seq)")
+
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()
+        self._seq = int(row[0]) if row else 0
+
+        # Changes made while the watcher was not running are unknown
+        self.renew()
+
+    def renew(self):
+        with self._lock:
+            self._epoch = uuid.uuid4().hex
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('epoch', ?)", [self._epoch])
+
+    def disable(self):
+        # Some directories can't be watched, so every listing walks the tree
+        with self._lock:
+            self._complete = False
+
+    def record(self, changes):
+        if not changes:
+            return
+
+        with self._lock:
+            self._seq += 1
+
+            self._conn.execute("BEGIN")
+            self._conn.executemany(" ".join(["INSERT INTO changes (path, seq, tree) VALUES (?, ?, ?)",
+                                             "ON CONFLICT(path) DO UPDATE SET",
+                                             "seq = excluded.seq, tree = MAX(tree, excluded.tree)"]),
+                                   [[path, self._seq, int(tree)] for path, tree in changes.items()])
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seq', ?)", [str(self._seq)])
+            self._conn.execute("COMMIT")
+
+    def token(self):
+        with self._lock:
+            return self._epoch + ":" + str(self._seq)
+
+    def _watched(self, path):
+        path = os.path.abspath(path)
+
+        for root in self._roots:
+            if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+                return True
+
+        return False
+
+    def changes(self, since, until, directories):
+        try:
+            epoch, start = since.split(":")
+            end = int(until.split(":")[1])
+            start = int(start)
+        except (AttributeError, ValueError):
+            return None
+
+        with self._lock:
+            if not self._complete or epoch != self._epoch:
+                return None
+
+            if not all([self._watched(item) for item in directories]):
+                return None
+
+            rows = self._conn.execute("SELECT path, tree FROM changes WHERE seq > ? AND seq <= ?",
+                                      [start, end]).fetchall()
+
+        # Changes outside the listed directories are not reported
+        result = []
+        for path, tree in rows:
+            for item in directories:
+                item = os.path.abspath(item)
+                if path == item or path.startswith(item.rstrip(os.sep) + os.sep):
+                    result.append((path, bool(tree)))
+                    break
+
+        return result
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+class Watcher(object):
+    _journal = None
+    _interval = None
+
+    def __init__(self, journal, roots, interval=1):
+        self._journal = journal
+        self._roots = [os.path.abspath(item) for item in roots]
+        self._interval = interval
+        self._inotify = Inotify()
+        self._watches = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _add_tree(self, root):
+        pending = [root]
+
+        while pending:
+            path = pending.pop()
+
+            try:
+                wd = self._inotify.add_watch(path)
+            except OSError as err:
+                if err.errno == errno.ENOSPC:
+                    logging.warning("Watch limit reached, journal disabled (raise fs.inotify.max_user_watches)")
+                    self._journal.disable()
+                    return
+                # Removed or unreadable, it is not listed
+                continue
+
+            self._watches[wd] = path
+
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+            except OSError:
+                pass
+
+    def _remove_tree(self, root):
+        prefix = root.rstrip(os.sep) + os.sep
+
+        for wd, path in list(self._watches.items()):
+            if path == root or path.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._watches[wd]
+
+    def _handle(self, changes, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events are lost: changes recorded so far are not enough anymore
+            logging.warning("Inotify queue overflow, journal renewed")
+            self._journal.record(changes)
+            changes.clear()
+            self._journal.renew()
+            return
+
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+
+        directory = self._watches.get(wd)
+        if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            return
+
+        if not name:
+            changes.setdefault(directory, False)
+            return
+
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self._remove_tree(path)
+            else:
+                self._add_tree(path)
+            changes[path] = True
+        else:
+            changes[path] = changes.get(path, False)
+
+        # Content of the directory is changed, so its times
+        changes.setdefault(directory, False)
+
+    def _run(self):
+        changes = {}
+        flushed = time.time()
+
+        while not self._stop.is_set():
+            for wd, mask, name in self._inotify.read(self._interval):
+                self._handle(changes, wd, mask, name)
+
+            if changes and (time.time() - flushed >= self._interval or len(changes) >= 10000):
+                self._journal.record(changes)
+                changes = {}
+                flushed = time.time()
+
+        self._journal.record(changes)
+
+    def start(self):
+        for root in self._roots:
+            self._add_tree(root)
+
+        # Tokens given while watches were added don't cover every change
+        self._journal.renew()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._inotify.close()
@@ -12,6 +12,8 @@ License       GPL version 2 (see GPL.txt for details)
   NOTE: This file is based from http://stackoverflow.com/a/32440
 """
 
+import threading
+
 import win32serviceutil
 import win32service
 import win32event
@@ -24,13 +26,16 @@ class AppServerSvc (win32serviceutil.ServiceFramework):
     _svc_display_name_ = "Syncropy Client"
 
     _socket = None
+    _stop = None
 
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
+        self._stop = threading.Event()
 
     def SvcStop(self):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
+        self._stop.set()
         self._socket.close()
 
         win32event.SetEvent(self.hWaitStop)
@@ -50,8 +55,12 @@ class AppServerSvc (win32serviceutil.ServiceFramework):
             "password": None
         }
 
+        params = {
+            "connections": 4
+        }
+
         self._socket = sclient.get_socket(port, address, ssl)
-        sclient.serve(self._socket)
+        sclient.serve(self._socket, params, self._stop)
 
 if __name__ == '__main__':
     win32serviceutil.HandleCommandLine(AppServerSvc)
\ No newline at end of file
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2012 Enrico Bianchi (enrico.bianchi@gmail.com)
+Project       Syncropy-ng
+Description   A backup system (server module)
+License       GPL version 2 (see GPL.txt for details)
+"""
+
+__author__ = "enrico"
+
+import datetime
+import re
+import sqlite3
+
+class Backend(object):
+    def schema(self, statement):
+        return [statement]
+
+    def prepare(self, cursor, statement):
+        return statement
+
+    def begin(self, conn):
+        pass
+
+    def commit(self, conn, retaining=False):
+        conn.commit()
+
+    def keeps_statements(self, retaining):
+        return retaining
+
+class FirebirdBackend(Backend):
+    def connect(self, cfg):
+        import fdb
+
+        return fdb.connect(host=cfg["database"]["host"],
+                           port=cfg["database"]["port"],
+                           database=cfg["database"]["dbname"],
+                           user=cfg["database"]["user"],
+                           password=cfg["database"]["password"],
+                           charset="UTF8")
+
+    def has_tables(self, conn):
+        cursor = conn.cursor()
+        cursor.execute(" ".join(["SELECT COUNT(rdb$relation_name)",
+                                 "FROM rdb$relations WHERE",
+                                 "rdb$relation_name NOT LIKE 'RDB$%'",
+                                 "AND rdb$relation_name NOT LIKE 'MON$%'"]))
+
+        value = cursor.fetchone()[0]
+        cursor.close()
+
+        return value > 0
+
+    def table_exists(self, conn, name):
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(rdb$relation_name) FROM rdb$relations WHERE rdb$relation_name = ?",
+                       [name.upper()])
+        value = cursor.fetchone()[0]
+        cursor.close()
+
+        return value > 0
+
+    def column_exists(self, conn, table, name):
+        cursor = conn.cursor()
+        cursor.execute(" ".join(["SELECT COUNT(rdb$field_name) FROM rdb$relation_fields",
+                                 "WHERE rdb$relation_name = ? AND rdb$field_name = ?"]),
+                       [table.upper(), name.upper()])
+        value = cursor.fetchone()[0]
+        cursor.close()
+
+        return value > 0
+
+    def reserve_ids(self, cursor, sequence, count):
+        # A whole block of identifiers is reserved with a single round trip
+        cursor.execute("SELECT GEN_ID({0}, {1}) FROM rdb$database".format(sequence, int(count)))
+        last = cursor.fetchone()[0]
+        return range(last - count + 1, last + 1)
+
+    def prepare(self, cursor, statement):
+        return cursor.prep(statement)
+
+    def starts_with(self, column, prefix):
+        return column + " STARTING WITH " + prefix
+
+    def commit(self, conn, retaining=False):
+        # Retaining commit keeps prepared statements and open cursors valid
+        conn.commit(retaining=retaining)
+
+class SQLiteBackend(Backend):
+    PRAGMAS = [
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -65536",
+        "PRAGMA mmap_size = 268435456"
+    ]
+
+    def connect(self, cfg):
+        timeout = cfg.getint("database", "timeout", fallback=60)
+
+        sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+
+        # Transactions are opened explicitly by batches, every other
+        # statement is committed at once to not lock out other processes
+        conn = sqlite3.connect(cfg["database"]["dbname"], timeout=timeout, isolation_level=None,
+                               cached_statements=256, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+
+        return conn
+
+    def schema(self, statement):
+        # Domains and column lengths are not enforced
+        if statement.startswith("CREATE DOMAIN") or re.match(r"ALTER TABLE \w+ ALTER COLUMN \w+ TYPE", statement):
+            return []
+
+        match = re.match(r"CREATE SEQUENCE (\w+)$", statement)
+        if match:
+            return ["CREATE TABLE IF NOT EXISTS sequences (name VARCHAR(31) PRIMARY KEY, value BIGINT)",
+                    "INSERT INTO sequences (name, value) VALUES ('" + match.group(1) + "', 0)"]
+
+        return [statement.replace(" CHARACTER SET UTF8", "")]
+
+    def has_tables(self, conn):
+        cursor = conn.execute("SELECT COUNT(name) FROM sqlite_master WHERE type = 'table'")
+        value = cursor.fetchone()[0]
+        cursor.close()
+
+        return value > 0
+
+    def table_exists(self, conn, name):
+        cursor = conn.execute("SELECT COUNT(name) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              [name.lower()])
+        value = cursor.fetchone()[0]
+        cursor.close()
+
+        return value > 0
+
+    def column_exists(self, conn, table, name):
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(" + table.lower() + ")")]
+
+        return name.lower() in columns
+
+    def reserve_ids(self, cursor, sequence, count):
+        # Update and read back must not interleave with other processes
+        started = not cursor.connection.in_transaction
+        if started:
+            cursor.execute("BEGIN IMMEDIATE")
+
+        cursor.execute("UPDATE sequences SET value = value + ? WHERE name = ?", [int(count), sequence])
+        cursor.execute("SELECT value FROM sequences WHERE name = ?", [sequence])
+        last = cursor.fetchone()[0]
+
+        if started:
+            cursor.connection.commit()
+
+        return range(last - count + 1, last + 1)
+
+    def begin(self, conn):
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+
+    def commit(self, conn, retaining=False):
+        if conn.in_transaction:
+            conn.commit()
+
+    def keeps_statements(self, retaining):
+        # Statements are cached by the connection and valid across transactions
+        return True
+
+    def starts_with(self, column, prefix):
+        # LIKE is avoided, because it ignores the case of ASCII letters
+        return "instr(" + column + ", " + prefix + ") = 1"
+
+ENGINES = {
+    "firebird": FirebirdBackend,
+    "sqlite": SQLiteBackend
+}
+
+def get_backend(cfg):
+    engine = cfg.get("database", "engine", fallback="firebird").lower()
+
+    if engine not in ENGINES:
+        raise ValueError("Unknown database engine " + engine)
+
+    return ENGINES[engine]()
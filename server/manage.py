@@ -8,13 +8,18 @@ License       GPL version 2 (see GPL.txt for details)
 
 __author__ = "enrico"
 
+import datetime
 import logging
+import os
 import pickle
+import queue
 import sync
+import time
 
 import storage
 
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import Process
 
 """
 NOTE:
@@ -33,6 +38,9 @@ Section:
 
 """
 
+# Extensions of already compressed files, transferred without compression
+SKIP_EXTENSIONS = ".gz,.tgz,.bz2,.xz,.lz4,.zst,.zip,.7z,.rar,.jpg,.jpeg,.png,.gif,.mp3,.mp4,.mkv,.avi"
+
 class Common(object):
     _cfg = None
     _grace = None
@@ -87,31 +95,277 @@ class Sync(Common):
         logger = logging.getLogger("Syncropy")
         logger.info("Started " + self.grace + " backup for dataset " + str(dataset))
 
-        # Remove old dataset
-        remove_dataset(self._cfg, self.grace, dataset)
+        with storage.Database(self._cfg) as dbs:
+            run = storage.db_get_run(dbs, self.grace, dataset) if reload else 0
+
+        if run:
+            # Reloaded run is resumed: completed listings and files are kept
+            logger.info("Resuming run " + str(run) + " of dataset " + str(dataset))
+        else:
+            # Remove old dataset
+            remove_dataset(self._cfg, self.grace, dataset)
+
+        with storage.Database(self._cfg) as dbs:
+            runs = {
+                "run": run or storage.db_new_run(dbs, self._cfg, self.grace, dataset),
+                "previous_run": storage.db_get_run(dbs, self.grace, previous_dataset(self._cfg, self.grace, dataset)),
+                "resume": bool(run)
+            }
+
+        reclaimer = None
+        if self._cfg.getboolean("general", "reclaim_background", fallback=False):
+            reclaimer = Process(target=reclaim, args=(self._cfg, False))
+            reclaimer.start()
 
-        with ProcessPoolExecutor(max_workers=5) as pool:  # NOTE: maximum concurrent processes is hardcoded for convenience
-            for section in sections:
-                if self._cfg[section]["type"] == "file":  # FIXME: useless?
-                    section = {
-                        "name": section,
-                        "grace": self._grace,
-                        "dataset": dataset,
-                        "compressed": self._cfg[section].getboolean("compress")
-                    }
+        sections = [section for section in sections if self._cfg[section]["type"] == "file"]  # FIXME: useless?
+        summaries = self._schedule(sections, dataset, runs)
 
-                    pool.submit(sync.fs_start, pickle.dumps(self._cfg), pickle.dumps(section))
+        for summary in summaries:
+            logger.info("{0}: {1} in {2:.1f} seconds, {3} files, {4} bytes transferred".format(
+                summary["name"], summary["result"], summary["duration"], summary["files"], summary["bytes"]))
+
+        with storage.Database(self._cfg) as dbs:
+            for summary in summaries:
+                storage.db_save_history(dbs, self.grace, dataset, summary)
 
         storage.db_set_last_dataset(self._cfg, self.grace, dataset)
-        logger.info("Backup ended")
 
+        if reclaimer:
+            reclaimer.join()
+
+        logger.info("Backup ended: {0} of {1} sections completed".format(
+            len([summary for summary in summaries if summary["result"] == "ok"]), len(summaries)))
+
+    def _section(self, name, dataset, runs):
+        codec, level = transfer_codec(self._cfg, name)
+
+        return {
+            "name": name,
+            "grace": self._grace,
+            "dataset": dataset,
+            "run": runs["run"],
+            "previous_run": runs["previous_run"],
+            "resume": runs["resume"],
+            "resume_min_size": self._cfg[name].getint("resume_min_size", fallback=2**26),
+            "buffer_size": self._cfg["general"].getint("buffer_size", fallback=2**22),
+            "compressed": self._cfg[name].getboolean("compress"),
+            "digests": self._cfg[name].getboolean("digests", fallback=False),
+            "algorithm": self._cfg[name].get("hash_algorithm", fallback="md5").lower(),
+            "delta": self._cfg[name].getboolean("delta", fallback=False),
+            "delta_min_size": self._cfg[name].getint("delta_min_size", fallback=2**20),
+            "batch_files": self._cfg[name].getint("transfer_batch_files", fallback=256),
+            "batch_bytes": self._cfg[name].getint("transfer_batch_bytes", fallback=2**22),
+            "batch_file_size": self._cfg[name].getint("transfer_batch_file_size", fallback=2**16),
+            "codec": codec,
+            "codec_level": level,
+            "codec_skip": [item.strip().lower() for item in
+                           self._cfg[name].get("transfer_skip", fallback=SKIP_EXTENSIONS).split(",")]
+        }
+
+    def _schedule(self, sections, dataset, runs):
+        logger = logging.getLogger("Syncropy")
+        workers = self._cfg.getint("general", "max_workers", fallback=5)
+        per_host = self._cfg.getint("general", "max_workers_per_host", fallback=0)
+
+        with storage.Database(self._cfg) as dbs:
+            durations = storage.db_get_durations(dbs)
+
+        # Longest sections first (sections never executed are considered the
+        # longest), so that a long section doesn't start at the end
+        pending = sorted(sections, key=lambda name: durations.get(name, float("inf")), reverse=True)
+        logger.debug("Sections order: " + ", ".join(pending))
+
+        summaries = []
+        running = {}
+        hosts = {}
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    if len(running) >= workers:
+                        break
+
+                    host = self._cfg[name]["host"]
+                    if per_host and hosts.get(host, 0) >= per_host:
+                        continue
+
+                    future = pool.submit(sync.fs_start, pickle.dumps(self._cfg),
+                                         pickle.dumps(self._section(name, dataset, runs)))
+                    running[future] = name
+                    hosts[host] = hosts.get(host, 0) + 1
+                    pending.remove(name)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    hosts[self._cfg[name]["host"]] -= 1
+
+                    try:
+                        summaries.append(future.result())
+                    except Exception as err:
+                        logger.error("Process for {0} failed: {1}".format(name, err))
+                        summaries.append({
+                            "name": name,
+                            "result": "ko",
+                            "started": datetime.datetime.now(),
+                            "duration": 0,
+                            "files": 0,
+                            "bytes": 0
+                        })
+
+        return summaries
+
+
+def transfer_codec(cfg, name):
+    logger = logging.getLogger("Syncropy")
+
+    # A wrong codec would fail every transfer after the client accepted it,
+    # so the section is saved without compression
+    try:
+        codec = cfg[name].get("transfer_codec", fallback="none").lower()
+        level = cfg[name].getint("transfer_level", fallback=None)
+        storage.fs_check_codec(codec, level)
+    except ValueError as err:
+        logger.error(name + ": Transfer compression disabled: " + str(err))
+        return "none", None
+
+    return codec, level
+
+def previous_dataset(cfg, grace, dataset):
+    if dataset == 1:
+        return int(cfg["dataset"][grace])
+    else:
+        return dataset - 1
 
 def remove_dataset(cfg, grace, dataset):
     logger = logging.getLogger("Syncropy")
     logger.info("Removing " + grace + " backup for dataset " + str(dataset))
+
+    # Dataset is moved to trash and its catalog rows are detached from it,
+    # while removing their content is left to reclamation
+    with storage.Database(cfg) as dbs:
+        run = storage.db_get_run(dbs, grace, int(dataset))
+        path = storage.fs_trash_dataset(cfg, grace, dataset, run)
+        storage.db_trash_run(dbs, grace, int(dataset), run, path)
+
+    logger.debug("Dataset " + str(dataset) + " tree for " + grace + " section moved to trash")
+
+def reclaim(cfg, store=True):
+    logger = logging.getLogger("Syncropy")
+    workers = cfg.getint("general", "reclaim_workers", fallback=4)
+    rate = cfg.getint("general", "reclaim_rate", fallback=0)
+
     with storage.Database(cfg) as dbs:
-        storage.db_del_dataset(dbs, grace, dataset)
-    logger.debug("Database cleaned")
+        for grace, run, path in storage.db_list_trash(dbs):
+            if path and os.path.exists(path):
+                count = storage.fs_reclaim(path, workers, rate)
+                logger.debug("Removed " + str(count) + " entries from " + path)
+
+            storage.db_del_run(dbs, grace, run)
+            dbs.commit()
+
+            # Datasets saved before runs have the dataset number as run, and
+            # run 0 is a dataset tree without catalog rows
+            if not run:
+                logger.info("Reclaimed " + str(path) + " of " + grace + " backup")
+            elif run <= cfg.getint("dataset", grace, fallback=0):
+                logger.info("Reclaimed legacy dataset " + str(run) + " of " + grace + " backup")
+            else:
+                logger.info("Reclaimed run " + str(run) + " of " + grace + " backup")
+
+        if store:
+            count = storage.fs_reclaim_store(cfg, dbs, rate)
+            logger.info("Removed " + str(count) + " unreferenced contents from store")
+
+            # Like the store, paths are purged only when no backup is running
+            count = storage.db_purge_paths(dbs)
+            logger.info("Removed " + str(count) + " unreferenced paths from catalog")
+
+            count = storage.fs_reclaim_partial(cfg, cfg.getint("general", "partial_days", fallback=7))
+            logger.info("Removed " + str(count) + " abandoned partial transfers")
+
+def restore(cfg, name, grace, dataset=None, prefix=None, target=None, workers=None):
+    logger = logging.getLogger("Syncropy")
+    workers = workers or cfg.getint("general", "restore_workers", fallback=4)
+
+    if dataset is None:
+        dataset = storage.db_get_last_dataset(cfg, grace)
+
+    with storage.Database(cfg) as dbs:
+        section = {
+            "name": name,
+            "grace": grace,
+            "dataset": int(dataset),
+            "run": storage.db_get_run(dbs, grace, int(dataset)),
+            "buffer_size": cfg["general"].getint("buffer_size", fallback=2**22)
+        }
+        items = list(storage.db_list_restore(dbs, section, prefix))
+
+    logger.info("Restoring " + str(len(items)) + " entries of " + name + " from " + grace +
+                " dataset " + str(dataset))
+
+    # Biggest files first, so that a big file doesn't start at the end
+    files = queue.Queue()
+    for item in sorted([item for item in items if item["attrs"]["type"] == "file"],
+                       key=lambda item: item["attrs"]["size"] or 0, reverse=True):
+        files.put(item)
+
+    # Directories are restored last and deepest first, so that their times
+    # aren't changed by the entries created in them
+    others = queue.Queue()
+    for item in [item for item in items if item["attrs"]["type"] == "symlink"]:
+        others.put(item)
+    for item in sorted([item for item in items if item["attrs"]["type"] == "directory"],
+                       key=lambda item: item["name"].count("/") + item["name"].count("\\"), reverse=True):
+        others.put(item)
+
+    started = time.time()
+    summary = {
+        "files": 0,
+        "bytes": 0,
+        "sent": 0,
+        "errors": 0
+    }
+
+    results = []
+    connections = min(workers, files.qsize())
+    if connections:
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            futures = [pool.submit(sync.fs_put_data, cfg, section, files, target) for _ in range(connections)]
+        results.extend([future.result() for future in futures])
+    if not others.empty():
+        results.append(sync.fs_put_data(cfg, section, others, target))
+
+    for stats in results:
+        for key in summary:
+            summary[key] += stats[key]
+
+    duration = max(time.time() - started, 0.001)
+    summary["duration"] = duration
+    summary["rate"] = summary["sent"] / duration / 2**20
+
+    logger.info("{0}: restored {1} entries, {2} bytes ({3} bytes transferred) in {4:.1f} seconds, "
+                "{5:.1f} MiB/s, {6} errors".format(name, summary["files"], summary["bytes"], summary["sent"],
+                                                   duration, summary["rate"], summary["errors"]))
+
+    return summary
+
+def check_catalog(cfg):
+    with storage.Database(cfg) as dbs:
+        return dbs.version >= storage.SCHEMA_VERSION
+
+def migrate(cfg):
+    logger = logging.getLogger("Syncropy")
+    batch = cfg.getint("database", "batch_size", fallback=1000)
+
+    with storage.Database(cfg) as dbs:
+        version = dbs.version
+        if version >= storage.SCHEMA_VERSION:
+            logger.info("Catalog already at schema version " + str(version))
+            return
+
+        logger.info("Migrating catalog from schema version " + str(version))
+        count = storage.db_migrate(dbs, batch)
 
-    storage.fs_remove_dataset(cfg, grace, dataset)
-    logger.debug("Dataset " + str(dataset) + " tree for " + grace + " section removed")
+    logger.info("Catalog migrated to schema version " + str(storage.SCHEMA_VERSION) +
+                " (" + str(count) + " rows)")
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2012 Enrico Bianchi (enrico.bianchi@gmail.com)
+Project       Syncropy-ng
+Description   A backup system (server module)
+License       GPL version 2 (see GPL.txt for details)
+"""
+
+__author__ = "enrico"
+
+import json
+import os
+import ssl
+import struct
+
+"""
+NOTE:
+
+Session:
+    A long-lived connection opened with the "session" system command. After
+    the acknowledge, every message is a frame
+
+Frame:
+    A 4 bytes big endian length followed by the payload. A response is a
+    JSON status frame, zero or more data frames and an empty frame which
+    closes it
+
+Listing:
+    With the binary format, the client sends a JSON line announcing it and
+    then a stream of records. Every record is a 4 bytes length, a fixed
+    header (shared name prefix, type, os, size, atime, mtime, ctime) and
+    the variable fields (name suffix, hash, mode, user, group, link, acl),
+    each one with a 4 bytes length. An empty record closes the stream
+
+Digests:
+    When asked, the client announces them in the listing header and the
+    server replies with the directory digests of the previous dataset, as
+    frames of JSON objects. Content of a directory with the same digest is
+    sent as a single "unchanged" entry, after the directory itself
+
+Changes:
+    When the list command has the token of a previous listing and the
+    client journal covers it, only the changed paths are sent: a "changed"
+    entry followed by the path itself, or a "tree" entry followed by the
+    whole tree, if it still exists. The header has the new token
+
+Hash:
+    The list command has the content hash algorithms accepted by the server
+    in order of preference (as "blake2b-32", with the digest size in bytes
+    for BLAKE2). The client hashes files with the first one it supports and
+    announces it in the header, without header the algorithm is MD5
+
+Sparse:
+    When the get command asks for it and the file has holes, the response
+    has the file size and is followed by the data extents (as frames of 8
+    bytes offset and length pairs, closed by an empty frame). Data frames
+    carry only the content of the extents, holes are zeros
+
+Batch:
+    The getbatch command has a list of files (name and codec). Its response
+    is followed, for every file, by a header message (name, result, codec
+    and size) and, if the file can be read, by its data frames closed by
+    an empty frame. An empty frame closes the batch
+
+Restore:
+    The put command has the client path, the codec and the metadata of an
+    entry (attrs and acl, as in the listing). A file is followed by its
+    data frames closed by an empty frame. Server doesn't wait the response
+    of a put command before sending the next one, the client answers every
+    one of them in order
+
+"""
+
+HEADER = struct.Struct(">I")
+EXTENT = struct.Struct(">QQ")
+MAX_FRAME = 2**26
+
+LIST_LENGTH = struct.Struct(">I")
+LIST_HEADER = struct.Struct(">HBBqqqq")
+LIST_NONE = 0xFFFFFFFF
+LIST_TYPES = ["file", "directory", "symlink", "unchanged", "changed", "tree"]
+LIST_MARKERS = ["unchanged", "changed", "tree"]
+LIST_SYSTEMS = ["posix", "nt"]
+
+def _recv_exact(conn, size):
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = conn.recv(min(size - len(data), 2**20))
+        if not chunk:
+            if data:
+                raise ConnectionError("Connection closed while reading a frame")
+            return None
+        data += chunk
+
+    return bytes(data)
+
+def recv_frame(conn):
+    header = _recv_exact(conn, HEADER.size)
+    if header is None:
+        return None
+
+    size = HEADER.unpack(header)[0]
+    if size > MAX_FRAME:
+        raise ValueError("Frame too large: " + str(size))
+    elif size == 0:
+        return b""
+
+    data = _recv_exact(conn, size)
+    if data is None:
+        raise ConnectionError("Connection closed while reading a frame")
+
+    return data
+
+def send_frame(conn, data=b""):
+    if len(data) < 2**16:
+        conn.sendall(HEADER.pack(len(data)) + data)
+    else:
+        conn.sendall(HEADER.pack(len(data)))
+        conn.sendall(data)
+
+def _zerocopy(conn):
+    if not isinstance(conn, ssl.SSLSocket):
+        return True
+
+    # TLS records are built by the kernel only if the connection was
+    # offloaded to it (kTLS), otherwise sendfile would copy in small blocks
+    sslobj = getattr(conn, "_sslobj", None)
+    return bool(sslobj and hasattr(sslobj, "uses_ktls_for_send") and sslobj.uses_ktls_for_send())
+
+def send_file(conn, f, buffer, block_size=2**23):
+    # Data frames of the file are sent by the kernel from the page cache,
+    # or through the given buffer
+    size = os.fstat(f.fileno()).st_size
+    zerocopy = _zerocopy(conn)
+    view = memoryview(buffer)
+    offset = 0
+
+    while offset < size:
+        count = min(block_size if zerocopy else len(view), size - offset)
+        conn.sendall(HEADER.pack(count))
+
+        if zerocopy:
+            sent = conn.sendfile(f, offset, count)
+        else:
+            f.seek(offset)
+            sent = f.readinto(view[:count])
+            conn.sendall(view[:sent])
+
+        if sent < count:
+            # File is truncated while sending, the frame is filled anyway
+            conn.sendall(bytes(count - sent))
+            break
+        offset += count
+
+    send_frame(conn)
+
+    return size
+
+def _recv_into(conn, view):
+    received = 0
+
+    while received < len(view):
+        count = conn.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Connection closed while reading a frame")
+        received += count
+
+def iter_data(conn, buffer):
+    # Payload of the frames is received into the buffer and yielded in
+    # chunks up to its size, every chunk is valid until the next one
+    view = memoryview(buffer)
+    header = memoryview(bytearray(HEADER.size))
+
+    while True:
+        try:
+            _recv_into(conn, header)
+        except ConnectionError:
+            raise ConnectionError("Connection closed before the end of the response")
+
+        size = HEADER.unpack(header)[0]
+        if size > MAX_FRAME:
+            raise ValueError("Frame too large: " + str(size))
+        elif size == 0:
+            break
+
+        while size > 0:
+            count = min(size, len(view))
+            _recv_into(conn, view[:count])
+            yield view[:count]
+            size -= count
+
+def iter_frames(conn):
+    while True:
+        data = recv_frame(conn)
+        if data is None:
+            raise ConnectionError("Connection closed before the end of the response")
+        elif not data:
+            break
+        yield data
+
+def recv_extents(conn):
+    extents = []
+
+    for data in iter_frames(conn):
+        extents.extend(EXTENT.iter_unpack(data))
+
+    return extents
+
+def recv_message(conn):
+    data = recv_frame(conn)
+    if data is None:
+        return None
+
+    return json.loads(data.decode("utf-8"))
+
+def send_message(conn, message):
+    send_frame(conn, json.dumps(message).encode("utf-8"))
+
+def send_response(conn, message):
+    send_message(conn, message)
+    send_frame(conn)
+
+def request(conn, command):
+    send_message(conn, command)
+    response = recv_message(conn)
+    if response is None:
+        raise ConnectionError("Connection closed before the response")
+
+    return response
+
+def _list_text(value):
+    if value is None:
+        return None
+
+    return value.decode("utf-8", "surrogateescape")
+
+def _read_list_record(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise ConnectionError("Connection closed while reading the listing")
+
+    return data
+
+def recv_list_header(f):
+    line = f.readline()
+    if not line:
+        return None
+
+    return json.loads(line.decode("utf-8"))
+
+def send_digests(conn, digests, size=10000):
+    items = list(digests.items())
+
+    for i in range(0, len(items), size):
+        send_message(conn, dict(items[i:i + size]))
+    send_frame(conn)
+
+def iter_list(f, header):
+    if header is None:
+        return
+    elif "format" not in header:
+        # Client without header sends a JSON line for every entry
+        yield header
+        for line in f:
+            yield json.loads(line.decode("utf-8"))
+        return
+    elif header["format"] != "binary":
+        for line in f:
+            yield json.loads(line.decode("utf-8"))
+        return
+
+    previous = b""
+    while True:
+        size = LIST_LENGTH.unpack(_read_list_record(f, LIST_LENGTH.size))[0]
+        if size == 0:
+            break
+        elif size > MAX_FRAME:
+            raise ValueError("Listing record too large: " + str(size))
+        payload = _read_list_record(f, size)
+
+        shared, itemtype, system, length, atime, mtime, ctime = LIST_HEADER.unpack_from(payload)
+        offset = LIST_HEADER.size
+
+        fields = []
+        for i in range(7):
+            length_field = LIST_LENGTH.unpack_from(payload, offset)[0]
+            offset += LIST_LENGTH.size
+
+            if length_field == LIST_NONE:
+                fields.append(None)
+            else:
+                fields.append(payload[offset:offset + length_field])
+                offset += length_field
+
+        name = previous[:shared] + fields[0]
+        previous = name
+
+        if LIST_TYPES[itemtype] in LIST_MARKERS:
+            yield {"result": LIST_TYPES[itemtype], "name": name.decode("utf-8", "surrogateescape")}
+            continue
+
+        result = {
+            "result": "ok",
+            "name": name.decode("utf-8", "surrogateescape"),
+            "os": LIST_SYSTEMS[system],
+            "attrs": {
+                "type": LIST_TYPES[itemtype],
+                "link": _list_text(fields[5]),
+                "size": None if length < 0 else length,
+                "hash": None if fields[1] is None else fields[1].hex(),
+                "atime": atime,
+                "mtime": mtime,
+                "ctime": ctime,
+                "mode": _list_text(fields[2]),
+                "user": _list_text(fields[3]),
+                "group": _list_text(fields[4])
+            }
+        }
+
+        if fields[6] is not None:
+            result["acl"] = json.loads(fields[6].decode("utf-8"))
+
+        yield result
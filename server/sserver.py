@@ -32,12 +32,26 @@ def init_args():
                       const="week", help="Weekly backup is executed")
     group.add_argument("-M", dest="grace", action='store_const',
                       const="month", help="Monthly backup is executed")
+    group.add_argument("--reclaim", action='store_const', const=True,
+                      help="Reclaim space of removed datasets")
+    group.add_argument("--migrate", action='store_const', const=True,
+                      help="Convert the catalog to the current schema")
     args.add_argument("-r", "--reload-dataset", action='store_const',
                       const=True, help="Reload a dataset")
     args.add_argument("--del-dataset", metavar="<dataset>",
                       help="Remove specified dataset")
     args.add_argument("--get-last-dataset", action='store_const',
                       const=True, help="Return last dataset processed")
+    args.add_argument("--restore", metavar="<section>",
+                      help="Restore a section from the dataset of the grace")
+    args.add_argument("--dataset", metavar="<dataset>", type=int,
+                      help="Dataset restored (default the last one)")
+    args.add_argument("--prefix", metavar="<path>",
+                      help="Restore only the entries under the path")
+    args.add_argument("--restore-to", metavar="<directory>",
+                      help="Restore the entries below the directory of the client")
+    args.add_argument("--restore-workers", metavar="<number>", type=int,
+                      help="Number of connections used by the restore")
 
     return args
 
@@ -78,7 +92,7 @@ def go(sysargs):
         cfg = configparser.ConfigParser()
         cfg.read(args.cfg)
 
-    if not args.grace:
+    if not args.grace and not args.reclaim and not args.migrate:
         print("Backup mode not defined")
         sys.exit(2)
 
@@ -86,6 +100,29 @@ def go(sysargs):
     set_log(filename=cfg.get("general", "log_file"),
             level=cfg.get("general", "log_level"))
 
+    if args.migrate:
+        manage.migrate(cfg)
+        sys.exit(0)
+
+    if not manage.check_catalog(cfg):
+        print("Catalog schema is outdated, convert it with --migrate")
+        sys.exit(4)
+
+    if args.reclaim:
+        manage.reclaim(cfg)
+        sys.exit(0)
+
+    if args.restore:
+        if not args.grace or not cfg.has_section(args.restore):
+            print("Restore needs a grace and a configured section")
+            sys.exit(2)
+
+        summary = manage.restore(cfg, args.restore, args.grace, args.dataset, args.prefix,
+                                 args.restore_to, args.restore_workers)
+        print("Restored {0} entries, {1} bytes in {2:.1f} seconds ({3:.1f} MiB/s), {4} errors".format(
+            summary["files"], summary["bytes"], summary["duration"], summary["rate"], summary["errors"]))
+        sys.exit(6 if summary["errors"] else 0)
+
     if args.get_last_dataset:
         # TODO: write code for getting last dataset processed
         sys.exit(0)
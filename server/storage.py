@@ -8,32 +8,194 @@ License       GPL version 2 (see GPL.txt for details)
 
 __author__ = "enrico"
 
-import json
+import atexit
+import bz2
+import datetime
+import errno
+import hashlib
 import logging
 import lzma
+import math
 import os
 import shutil
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 
-import fdb
+import backends
+import protocol
+
+# Block signature (weak and strong checksum) and copy instruction of delta
+DELTA_SIGNATURE = struct.Struct(">I16s")
+DELTA_COPY = struct.Struct(">QI")
+
+# Version 2 interns paths, owners and areas into dictionary tables, catalog
+# rows reference them by integer key
+SCHEMA_VERSION = 2
+
+SCHEMA_CATALOG = [
+    "CREATE SEQUENCE seq_areas",
+    "CREATE SEQUENCE seq_owners",
+    "CREATE SEQUENCE seq_paths",
+    " ".join(["CREATE TABLE schema_info (",
+              "version INTEGER,",
+              "upgraded TIMESTAMP)"]),
+    " ".join(["CREATE TABLE areas (",
+              "id INTEGER NOT NULL PRIMARY KEY,",
+              "name VARCHAR(30) CHARACTER SET UTF8)"]),
+    " ".join(["CREATE TABLE owners (",
+              "id INTEGER NOT NULL PRIMARY KEY,",
+              "name VARCHAR(50) CHARACTER SET UTF8)"]),
+    " ".join(["CREATE TABLE paths (",
+              "id BIGINT NOT NULL PRIMARY KEY,",
+              "area INTEGER,",
+              "hash CHAR(32) CHARACTER SET UTF8,",
+              "element VARCHAR(1024) CHARACTER SET UTF8)"]),
+    " ".join(["CREATE TABLE entries (",
+              "area INTEGER,",
+              "grace VARCHAR(5) CHARACTER SET UTF8,",
+              "dataset INTEGER,",
+              "path BIGINT,",
+              "os VARCHAR(32) CHARACTER SET UTF8,",
+              "username INTEGER,",
+              "groupname INTEGER,",
+              "type VARCHAR(9) CHARACTER SET UTF8,",
+              "link VARCHAR(1024) CHARACTER SET UTF8,",
+              "hash VARCHAR(128) CHARACTER SET UTF8,",
+              "perms VARCHAR(32) CHARACTER SET UTF8,",
+              "mtime BIGINT,",
+              "ctime BIGINT,",
+              "size BIGINT,",
+              "compressed BOOLEAN,",
+              "algorithm VARCHAR(16) CHARACTER SET UTF8)"]),
+    " ".join(["CREATE TABLE entry_acls (",
+              "area INTEGER,",
+              "grace VARCHAR(5) CHARACTER SET UTF8,",
+              "dataset INTEGER,",
+              "path BIGINT,",
+              "name INTEGER,",
+              "type VARCHAR(5) CHARACTER SET UTF8,",
+              "perms VARCHAR(3) CHARACTER SET UTF8,",
+              "scope VARCHAR(7) CHARACTER SET UTF8)"]),
+    "CREATE INDEX idx_areas_1 ON areas(name)",
+    "CREATE INDEX idx_owners_1 ON owners(name)",
+    "CREATE INDEX idx_paths_1 ON paths(area, hash)",
+    "CREATE INDEX idx_entries_1 ON entries(area, grace, dataset, type)",
+    "CREATE INDEX idx_entries_2 ON entries(area, grace, dataset, path)",
+    "CREATE INDEX idx_entries_3 ON entries(grace, dataset)",
+    "CREATE INDEX idx_entry_acls_1 ON entry_acls(area, grace, dataset, path)",
+    "CREATE INDEX idx_entry_acls_2 ON entry_acls(grace, dataset)"
+]
+
+# Maximum number of values looked up with a single IN predicate
+LOOKUP_SIZE = 500
+
+def close_statements(statements):
+    for cursor, prepared in statements.values():
+        cursor.close()
+    statements.clear()
+
+class ConnectionPool(object):
+    _size = None
+
+    def __init__(self, size=4):
+        self._size = size
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._idle = {}
+        self._checked = set()
+        self._orphans = []
+
+    def _key(self, cfg):
+        return tuple([cfg.get("database", item, fallback=None)
+                      for item in ["engine", "host", "port", "dbname", "user"]])
+
+    def _forked(self):
+        # Connections inherited from the parent process must not be used, and
+        # neither closed, by the child
+        if self._pid != os.getpid():
+            for connections in self._idle.values():
+                self._orphans.extend(connections)
+            self._idle = {}
+            self._pid = os.getpid()
+
+    def acquire(self, cfg, backend):
+        key = self._key(cfg)
+
+        with self._lock:
+            self._forked()
+
+            if self._idle.get(key):
+                conn, statements = self._idle[key].pop()
+            else:
+                conn = None
+
+            checked = key in self._checked
+            self._checked.add(key)
+
+        # Prepared statements are kept with the connection, so that they are
+        # reused by every Database instance which gets it
+        if conn is None:
+            conn = backend.connect(cfg)
+            statements = {}
+
+        return key, conn, statements, checked
+
+    def release(self, key, conn, statements):
+        with self._lock:
+            self._forked()
+
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._size:
+                idle.append((conn, statements))
+                conn = None
+
+        if conn is not None:
+            close_statements(statements)
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            self._forked()
+
+            for connections in self._idle.values():
+                for conn, statements in connections:
+                    try:
+                        close_statements(statements)
+                        conn.close()
+                    except:
+                        pass
+            self._idle = {}
+
+# Connections are shared by every Database instance of the process, and the
+# schema is checked only by the first one
+POOL = ConnectionPool()
+atexit.register(POOL.close)
 
 class Database():
     _conn = None
+    _backend = None
+    _key = None
 
     @property
     def connection(self):
         return self._conn
 
+    @property
+    def backend(self):
+        return self._backend
+
     def __init__(self, cfg):
-        self._conn = fdb.connect(host=cfg["database"]["host"],
-                                 port=cfg["database"]["port"],
-                                 database=cfg["database"]["dbname"],
-                                 user=cfg["database"]["user"],
-                                 password=cfg["database"]["password"],
-                                 charset="UTF8")
+        self._backend = backends.get_backend(cfg)
+        self._key, self._conn, self._statements, checked = POOL.acquire(cfg, self._backend)
 
-        if not self._check_schema():
-            self._create_schema()
+        if not checked:
+            if not self._check_schema():
+                self._create_schema()
+            self._upgrade_schema()
 
     def __enter__(self):
         return self
@@ -41,64 +203,167 @@ class Database():
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
             if self._conn:
-                self._conn.commit()
-                self._conn.close()
+                self.commit()
+                POOL.release(self._key, self._conn, self._statements)
         except:
-            pass
+            try:
+                self._conn.close()
+            except:
+                pass
+        finally:
+            self._conn = None
 
     def _check_schema(self):
-        cursor = self._conn.cursor()
-        cursor.execute(" ".join(["SELECT COUNT(rdb$relation_name)",
-                                 "FROM rdb$relations WHERE",
-                                 "rdb$relation_name NOT LIKE 'RDB$%'",
-                                 "AND rdb$relation_name NOT LIKE 'MON$%'"]))
+        return self._backend.has_tables(self._conn)
 
-        value = cursor.fetchone()[0]
-        cursor.close()
+    def _check_table(self, name):
+        return self._backend.table_exists(self._conn, name)
 
-        if value == 0:
-            return False
-        else:
-            return True
+    def _check_column(self, table, name):
+        return self._backend.column_exists(self._conn, table, name)
 
-    def _create_schema(self):
-        domains = ["CREATE DOMAIN BOOLEAN AS SMALLINT CHECK (value is null or value in (0, 1))"]
+    def _execute_schema(self, cursor, statement):
+        for item in self._backend.schema(statement):
+            cursor.execute(item)
+
+    def begin(self):
+        self._backend.begin(self._conn)
+
+    def commit(self, retaining=False):
+        self._backend.commit(self._conn, retaining)
+
+        # Prepared statements are released only if the backend ends them
+        # with the transaction
+        if not self._backend.keeps_statements(retaining):
+            close_statements(self._statements)
+
+    def execute(self, statement, params=None):
+        if statement not in self._statements:
+            cursor = self._conn.cursor()
+            self._statements[statement] = (cursor, self._backend.prepare(cursor, statement))
+
+        cursor, prepared = self._statements[statement]
+        cursor.execute(prepared, params or [])
+
+        return cursor
+
+    def reserve_ids(self, cursor, sequence, count):
+        return self._backend.reserve_ids(cursor, sequence, count)
+
+    def prepare(self, cursor, statement):
+        return self._backend.prepare(cursor, statement)
+
+    def _upgrade_schema(self):
+        # Tables added after the first schema, created on existing databases
+        upgrades = [
+            ("store", [
+                " ".join(["CREATE TABLE store (",
+                          "hash VARCHAR(128) CHARACTER SET UTF8,",
+                          "compressed BOOLEAN,",
+                          "stored TIMESTAMP,",
+                          "algorithm VARCHAR(16) CHARACTER SET UTF8)"]),
+                "CREATE INDEX idx_store_1 ON store(hash, compressed)"
+            ]),
+            ("history", [
+                " ".join(["CREATE TABLE history (",
+                          "area VARCHAR(30) CHARACTER SET UTF8,",
+                          "grace VARCHAR(5) CHARACTER SET UTF8,",
+                          "dataset INTEGER,",
+                          "started TIMESTAMP,",
+                          "duration DOUBLE PRECISION,",
+                          "bytes BIGINT,",
+                          "files INTEGER,",
+                          "result VARCHAR(2) CHARACTER SET UTF8)"]),
+                "CREATE INDEX idx_history_1 ON history(started, area)"
+            ]),
+            ("runs", [
+                " ".join(["CREATE TABLE runs (",
+                          "grace VARCHAR(5) CHARACTER SET UTF8,",
+                          "dataset INTEGER,",
+                          "run INTEGER)"]),
+                "CREATE INDEX idx_runs_1 ON runs(grace, dataset)"
+            ]),
+            ("trash", [
+                " ".join(["CREATE TABLE trash (",
+                          "grace VARCHAR(5) CHARACTER SET UTF8,",
+                          "run INTEGER,",
+                          "path VARCHAR(1024) CHARACTER SET UTF8,",
+                          "removed TIMESTAMP)"])
+            ]),
+            ("listings", [
+                " ".join(["CREATE TABLE listings (",
+                          "area VARCHAR(30) CHARACTER SET UTF8,",
+                          "grace VARCHAR(5) CHARACTER SET UTF8,",
+                          "dataset INTEGER,",
+                          "listed TIMESTAMP)"]),
+                "CREATE INDEX idx_listings_1 ON listings(area, grace, dataset)"
+            ]),
+            ("journal_tokens", [
+                " ".join(["CREATE TABLE journal_tokens (",
+                          "area VARCHAR(30) CHARACTER SET UTF8,",
+                          "grace VARCHAR(5) CHARACTER SET UTF8,",
+                          "dataset INTEGER,",
+                          "token VARCHAR(64) CHARACTER SET UTF8)"]),
+                "CREATE INDEX idx_journal_tokens_1 ON journal_tokens(area, grace, dataset)"
+            ]),
+            ("progress", [
+                " ".join(["CREATE TABLE progress (",
+                          "area VARCHAR(30) CHARACTER SET UTF8,",
+                          "grace VARCHAR(5) CHARACTER SET UTF8,",
+                          "dataset INTEGER,",
+                          "path BIGINT,",
+                          "bytes BIGINT,",
+                          "saved TIMESTAMP)"]),
+                "CREATE INDEX idx_progress_1 ON progress(area, grace, dataset)"
+            ]),
+            ("copy_paths", [
+                " ".join(["CREATE TABLE copy_paths (",
+                          "area INTEGER,",
+                          "grace VARCHAR(5) CHARACTER SET UTF8,",
+                          "dataset INTEGER,",
+                          "path BIGINT)"]),
+                "CREATE INDEX idx_copy_paths_1 ON copy_paths(area, grace, dataset, path)"
+            ])
+        ]
+
+        for table, statements in upgrades:
+            if not self._check_table(table):
+                with closing(self._conn.cursor()) as cursor:
+                    for item in statements:
+                        self._execute_schema(cursor, item)
+                        self._conn.commit()
 
-        index = [
-            "CREATE INDEX idx_attrs_1 ON attrs(area, grace, dataset)",
-            "CREATE INDEX idx_attrs_2 ON attrs(area, grace, dataset, hash)",
-            "CREATE INDEX idx_attrs_3 ON attrs(area, grace, dataset, type)",
-            "CREATE INDEX idx_acls_1 ON acls(area, grace, dataset)"
+        # Columns added after the first schema, a missing algorithm is MD5
+        # and a missing scope is the access ACL
+        columns = [
+            ("entries", "algorithm", [
+                "ALTER TABLE entries ADD algorithm VARCHAR(16) CHARACTER SET UTF8",
+                "ALTER TABLE entries ALTER COLUMN hash TYPE VARCHAR(128) CHARACTER SET UTF8"
+            ]),
+            ("store", "algorithm", [
+                "ALTER TABLE store ADD algorithm VARCHAR(16) CHARACTER SET UTF8",
+                "ALTER TABLE store ALTER COLUMN hash TYPE VARCHAR(128) CHARACTER SET UTF8"
+            ]),
+            ("entry_acls", "scope", [
+                "ALTER TABLE entry_acls ADD scope VARCHAR(7) CHARACTER SET UTF8"
+            ])
         ]
 
+        for table, column, statements in columns:
+            if self._check_table(table) and not self._check_column(table, column):
+                with closing(self._conn.cursor()) as cursor:
+                    for item in statements:
+                        self._execute_schema(cursor, item)
+                        self._conn.commit()
+
+    def _create_schema(self):
+        domains = ["CREATE DOMAIN BOOLEAN AS SMALLINT CHECK (value is null or value in (0, 1))"]
+
         tables = [
             " ".join(["CREATE TABLE status (",
                       "grace VARCHAR(5) CHARACTER SET UTF8,",
                       " actual INTEGER,",
-                      " last_run TIMESTAMP)"]),
-            " ".join(["CREATE TABLE attrs (",
-                      "area VARCHAR(30) CHARACTER SET UTF8,",
-                      "grace VARCHAR(5) CHARACTER SET UTF8,",
-                      "dataset INTEGER,",
-                      "element VARCHAR(1024) CHARACTER SET UTF8,",
-                      "os VARCHAR(32) CHARACTER SET UTF8,",
-                      "username VARCHAR(50) CHARACTER SET UTF8,",
-                      "groupname VARCHAR(50) CHARACTER SET UTF8,",
-                      "type VARCHAR(9) CHARACTER SET UTF8,",
-                      "link VARCHAR(1024) CHARACTER SET UTF8,",
-                      "hash VARCHAR(32) CHARACTER SET UTF8,",
-                      "perms VARCHAR(32) CHARACTER SET UTF8,",
-                      "mtime BIGINT,",
-                      "ctime BIGINT,",
-                      "compressed BOOLEAN)"]),
-            " ".join(["CREATE TABLE acls (",
-                      "area VARCHAR(30) CHARACTER SET UTF8,",
-                      "grace VARCHAR(5) CHARACTER SET UTF8,",
-                      "dataset INTEGER,",
-                      "element VARCHAR(1024) CHARACTER SET UTF8,",
-                      "name VARCHAR(50) CHARACTER SET UTF8,",
-                      "type VARCHAR(5) CHARACTER SET UTF8,",
-                      "perms VARCHAR(3) CHARACTER SET UTF8)"])
+                      " last_run TIMESTAMP)"])
         ]
 
         data = [
@@ -111,15 +376,11 @@ class Database():
         cursor = self._conn.cursor()
 
         for item in domains:
-            cursor.execute(item)
+            self._execute_schema(cursor, item)
         self._conn.commit()
 
         for item in tables:
-            cursor.execute(item)
-        self._conn.commit()
-
-        for item in index:
-            cursor.execute(item)
+            self._execute_schema(cursor, item)
         self._conn.commit()
 
         for item in data:
@@ -128,6 +389,36 @@ class Database():
 
         cursor.close()
 
+        self.create_catalog()
+        self.set_version(SCHEMA_VERSION)
+
+    def create_catalog(self):
+        if self._check_table("entries"):
+            return
+
+        with closing(self._conn.cursor()) as cursor:
+            for item in SCHEMA_CATALOG:
+                self._execute_schema(cursor, item)
+                self._conn.commit()
+
+    @property
+    def version(self):
+        if self._check_table("schema_info"):
+            with closing(self._conn.cursor()) as cursor:
+                cursor.execute("SELECT MAX(version) FROM schema_info")
+                return cursor.fetchone()[0] or 0
+        elif self._check_table("attrs"):
+            # Catalog created before the schema was versioned
+            return 1
+        else:
+            return 0
+
+    def set_version(self, version):
+        with closing(self._conn.cursor()) as cursor:
+            cursor.execute("DELETE FROM schema_info")
+            cursor.execute("INSERT INTO schema_info (version, upgraded) VALUES (?, CURRENT_TIMESTAMP)", [version])
+        self._conn.commit()
+
 def fs_compute_destination(cfg, section, previous):
     if previous:
         if section["dataset"] == 1:
@@ -143,48 +434,654 @@ def fs_compute_destination(cfg, section, previous):
                                section["name"]])
     return destination
 
-def fs_save(cfg, section, data, previous=False, conn=None):
+def fs_item_name(data):
+    if data["os"] == "nt":
+        return data["name"].replace("\\", "/").replace(":", "")
+    else:
+        return data["name"]
+
+def fs_item_destination(cfg, section, data):
+    item = fs_item_name(data)
+
+    return item, os.sep.join([fs_compute_destination(cfg, section, False), item])
+
+def fs_temp_path(cfg, data):
+    temp = os.sep.join([cfg["general"]["repository"], "store", "tmp",
+                        str(os.getpid()) + "-" + data["attrs"]["hash"]])
+    os.makedirs(os.path.dirname(temp), exist_ok=True)
+
+    return temp
+
+def fs_keep_file(cfg, section, data, temp, dest, digest, dbm=None):
     logger = logging.getLogger("Syncropy")
+    suffix = ".compressed" if section["compressed"] else ""
+    algorithm = data["attrs"].get("algorithm", "md5")
 
-    if data["os"] == "nt":
-        item = data["name"].replace("\\", "/").replace(":", "")
+    # Content is linked in the dataset before the store, so reclamation
+    # never finds it with a single link
+    os.replace(temp + suffix, dest + suffix)
+
+    if digest == data["attrs"]["hash"]:
+        blob = fs_store_path(cfg, digest, section["compressed"], algorithm)
+        fs_store_add(dbm, dest + suffix, blob, digest, section["compressed"], algorithm)
     else:
-        item = data["name"]
+        # File is changed after listing, so its content can't be
+        # saved in the store with the listed hash
+        logger.warning(section["name"] + ": File " + data["name"] + " changed during transfer")
+
+def fs_remove_temp(temp):
+    for path in [temp, temp + ".compressed"]:
+        if os.path.exists(path):
+            os.remove(path)
 
-    dest = os.sep.join([fs_compute_destination(cfg, section, False), item])
+def fs_save(cfg, section, data, previous=False, conn=None, delta=False, dbm=None, connect=None):
+    logger = logging.getLogger("Syncropy")
+    item, dest = fs_item_destination(cfg, section, data)
 
     if data["attrs"]["type"] == "directory":
         os.makedirs(dest)
     elif data["attrs"]["type"] == "symlink":
         os.symlink(data["attrs"]["link"], dest)
     elif data["attrs"]["type"] == "file":
+        suffix = ".compressed" if section["compressed"] else ""
+        algorithm = data["attrs"].get("algorithm", "md5")
+        blob = fs_store_path(cfg, data["attrs"]["hash"], section["compressed"], algorithm)
+
+        if section.get("resume") and os.path.lexists(dest + suffix):
+            # Saved by the interrupted run, but not recorded as completed
+            os.remove(dest + suffix)
+
         if previous:
-            source = os.sep.join([fs_compute_destination(cfg, section, True), item])
+            source = os.sep.join([fs_compute_destination(cfg, section, True), item]) + suffix
 
-            if section["compressed"]:
-                os.link(source + ".compressed", dest + ".compressed")
-            else:
-                os.link(source, dest)
+            if not os.path.exists(blob) and fs_hash_file(source, section["compressed"],
+                                                         algorithm) == data["attrs"]["hash"]:
+                # Copies saved before the store are added to it, unless
+                # they were changed during their transfer
+                fs_store_add(dbm, source, blob, data["attrs"]["hash"], section["compressed"], algorithm)
+            fs_link(source, dest + suffix)
+        elif fs_link_stored(blob, dest + suffix):
+            logger.debug(section["name"] + ": File " + data["name"] + " found in store")
         else:
-            cmdget = {
-                "context": "file",
-                "command": {
-                    "name": "get",
-                    "filename": data["name"]
-                }
-            }
-            conn.send(json.dumps(cmdget).encode("utf-8"))
-            logger.debug(section["name"] + ": Transfer file " + data["name"])
+            if conn is None:
+                # Session is opened only when content isn't in store
+                conn = connect()
+            temp = fs_temp_path(cfg, data)
+
+            try:
+                received = None
+                if delta:
+                    received = fs_get_delta(cfg, section, data, item, temp, conn)
+
+                if received is not None:
+                    digest = data["attrs"]["hash"]
+                    if section["compressed"]:
+                        fs_compress_file(temp)
+                elif (data["attrs"].get("size") or 0) >= section.get("resume_min_size", 2**26):
+                    digest, received = fs_get_partial(cfg, section, data, conn)
+                    if digest is None:
+                        return None
+
+                    os.replace(fs_partial_path(cfg, section, data), temp)
+                    if section["compressed"]:
+                        fs_compress_file(temp)
+                else:
+                    digest, received = fs_get_file(section, data, temp, conn)
+                    if digest is None:
+                        return None
+
+                fs_keep_file(cfg, section, data, temp, dest, digest, dbm)
+            finally:
+                fs_remove_temp(temp)
+
+            return received
+
+    return 0
+
+def fs_save_batch(cfg, section, items, conn, dbm=None):
+    logger = logging.getLogger("Syncropy")
+    suffix = ".compressed" if section["compressed"] else ""
+    cmdbatch = {
+        "context": "file",
+        "command": {
+            "name": "getbatch",
+            "files": [{"filename": data["name"], "compress": fs_get_codec(section, data)} for data in items]
+        }
+    }
+
+    # Small files are transferred with a single command, every one of them
+    # is a header followed by its data frames
+    response = protocol.request(conn, cmdbatch)
+    if response["result"] != "ok":
+        for _ in protocol.iter_frames(conn):
+            pass
+        logger.debug(section["name"] + ": Batch transfer refused: " + response.get("message", ""))
+        return None
+
+    result = []
+    for data in items:
+        header = protocol.recv_message(conn)
+        if header is None:
+            raise ConnectionError("Connection closed before the end of the batch")
+        elif header.get("name") != data["name"]:
+            raise ValueError("Unexpected file in batch: " + str(header.get("name")))
 
-            with open(dest, "wb") as destfile:
-                while True:
-                    data = conn.recv(2048)
+        if header["result"] != "ok":
+            logger.error(section["name"] + ": Cannot transfer file " + data["name"] + ": " + header["message"])
+            result.append(None)
+            continue
+
+        item, dest = fs_item_destination(cfg, section, data)
+        if section.get("resume") and os.path.lexists(dest + suffix):
+            os.remove(dest + suffix)
+
+        temp = fs_temp_path(cfg, data)
+        try:
+            digest, received = fs_receive(conn, temp, header.get("codec", "none"), section["compressed"],
+                                          hasher=fs_get_hasher(data["attrs"].get("algorithm", "md5")),
+                                          buffer_size=section.get("buffer_size", 2**22))
+            fs_keep_file(cfg, section, data, temp, dest, digest, dbm)
+        finally:
+            fs_remove_temp(temp)
+
+        result.append(received)
+
+    if protocol.recv_frame(conn) != b"":
+        raise ValueError("Batch not closed")
+
+    logger.debug(section["name"] + ": Transfer batch of " + str(len(items)) + " files")
+
+    return result
+
+def fs_store_path(cfg, hashed, compressed, algorithm="md5"):
+    # Contents hashed with other algorithms than MD5 have their own tree
+    store = os.sep.join([cfg["general"]["repository"], "store"])
+    if algorithm and algorithm != "md5":
+        store = os.sep.join([store, algorithm])
+
+    path = os.sep.join([store, hashed[:2], hashed[2:4], hashed])
+    if compressed:
+        path += ".compressed"
+
+    return path
+
+def fs_in_store(cfg, section, data):
+    return os.path.exists(fs_store_path(cfg, data["attrs"]["hash"], section["compressed"],
+                                        data["attrs"].get("algorithm", "md5")))
+
+def fs_get_hasher(algorithm="md5"):
+    name, _, size = (algorithm or "md5").partition("-")
+
+    if name in ["blake2b", "blake2s"]:
+        return getattr(hashlib, name)(digest_size=int(size or (64 if name == "blake2b" else 32)))
+    elif size:
+        raise ValueError("Digest size not supported by " + name)
+
+    return hashlib.new(name)
+
+def fs_hash_file(path, compressed, algorithm="md5"):
+    hasher = fs_get_hasher(algorithm)
+
+    with (lzma.open(path) if compressed else open(path, "rb")) as f:
+        for data in iter(lambda: f.read(2**20), b""):
+            hasher.update(data)
+
+    return hasher.hexdigest()
+
+def fs_store_add(dbm, source, blob, hashed, compressed, algorithm=None):
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+
+    try:
+        os.link(source, blob)
+    except FileExistsError:
+        return
+
+    if dbm:
+        db_save_store(dbm, hashed, compressed, algorithm)
+
+def fs_link_stored(blob, dest):
+    # Content can be removed from store by reclamation at any time
+    try:
+        fs_link(blob, dest)
+        return True
+    except FileNotFoundError:
+        return False
+
+def fs_link(source, dest):
+    try:
+        os.link(source, dest)
+    except OSError as err:
+        if err.errno != errno.EMLINK:
+            raise
+
+        # Maximum number of links to the inode is reached, so the source is
+        # replaced with a new copy
+        temp = source + "." + str(os.getpid())
+        shutil.copy2(source, temp)
+        os.replace(temp, source)
+        os.link(source, dest)
+
+# Compression levels accepted by the codecs of the client
+CODEC_LEVELS = {"none": None, "zlib": range(-1, 10), "lzma": range(0, 10), "bz2": range(1, 10)}
+
+def fs_check_codec(codec, level):
+    if codec not in CODEC_LEVELS:
+        raise ValueError("Unknown codec " + codec)
+    elif level is not None and CODEC_LEVELS[codec] is not None and level not in CODEC_LEVELS[codec]:
+        raise ValueError("Level " + str(level) + " not supported by " + codec)
+
+def fs_get_codec(section, data):
+    codec = section.get("codec", "none")
+
+    # Already compressed files are transferred as they are
+    if os.path.splitext(data["name"])[1].lower() in section.get("codec_skip", []):
+        codec = "none"
+
+    return {"codec": codec, "level": section.get("codec_level")}
+
+def fs_get_decompressor(codec):
+    if codec == "zlib":
+        return zlib.decompressobj()
+    elif codec == "lzma":
+        return lzma.LZMADecompressor()
+    elif codec == "bz2":
+        return bz2.BZ2Decompressor()
+    elif codec == "none":
+        return None
+    else:
+        raise ValueError("Unknown codec " + codec)
+
+def fs_decompress(decompressor, data):
+    # Output is produced in bounded chunks, because highly compressible data
+    # can expand a lot
+    if hasattr(decompressor, "unconsumed_tail"):
+        while data:
+            chunk = decompressor.decompress(data, 2**20)
+            data = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+    else:
+        chunk = decompressor.decompress(data, 2**20)
+        while chunk:
+            yield chunk
+            if decompressor.eof or decompressor.needs_input:
+                break
+            chunk = decompressor.decompress(b"", 2**20)
+
+# Receive buffers are allocated once per thread and reused by every file
+_buffers = threading.local()
+
+def fs_buffer(size):
+    if getattr(_buffers, "data", None) is None or len(_buffers.data) != size:
+        _buffers.data = bytearray(size)
+
+    return _buffers.data
+
+# Zeros hashed in place of the holes of sparse files
+ZEROS = memoryview(bytes(2**20))
+
+class SparseWriter(object):
+    _file = None
+    _hasher = None
+
+    def __init__(self, destfile, hasher, extents, size, position=0, seekable=True):
+        self._file = destfile
+        self._hasher = hasher
+        self._extents = list(extents)
+        self._size = size
+        self._position = position
+        self._remaining = 0
+        self._seekable = seekable
+
+    def _fill(self, end):
+        # Holes are skipped on disk, but they are part of the content hash
+        length = end - self._position
+        while length > 0:
+            count = min(length, len(ZEROS))
+            self._hasher.update(ZEROS[:count])
+            if not self._seekable:
+                self._file.write(ZEROS[:count])
+            length -= count
+
+        if self._seekable:
+            self._file.seek(end)
+        self._position = end
+
+    def write(self, data):
+        view = memoryview(data)
+
+        while len(view):
+            if not self._remaining:
+                if not self._extents:
+                    raise ValueError("Data beyond the extents of the sparse file")
+
+                start, self._remaining = self._extents.pop(0)
+                self._fill(start)
+
+            count = min(len(view), self._remaining)
+            self._file.write(view[:count])
+            self._hasher.update(view[:count])
+            self._position += count
+            self._remaining -= count
+            view = view[count:]
+
+    def close(self):
+        self._fill(self._size)
+        if self._seekable:
+            self._file.truncate(self._size)
+
+def fs_receive(conn, dest, codec, compressed, offset=0, hasher=None, buffer_size=2**22, extents=None, size=None):
+    if hasher is None:
+        hasher = hashlib.md5()
+    decompressor = fs_get_decompressor(codec)
+    buffer = fs_buffer(buffer_size)
+    received = 0
+
+    if compressed and codec == "lzma" and extents is None:
+        # Stream is already in the format of the compressed copy, it is
+        # decompressed only for checking the hash
+        with open(dest + ".compressed", "wb") as destfile:
+            for chunk in protocol.iter_data(conn, buffer):
+                received += len(chunk)
+                destfile.write(chunk)
+                for data in fs_decompress(decompressor, chunk):
+                    hasher.update(data)
+    else:
+        if compressed:
+            destfile = lzma.open(dest + ".compressed", "wb")
+        elif offset:
+            # Data is appended to the one received before
+            destfile = open(dest, "r+b")
+            destfile.seek(offset)
+            destfile.truncate()
+        else:
+            destfile = open(dest, "wb")
+
+        with destfile:
+            # Data of a sparse file is written at its extents
+            writer = None
+            if extents is not None:
+                writer = SparseWriter(destfile, hasher, extents, size, offset, not compressed)
+                write = writer.write
+            else:
+                def write(data):
+                    destfile.write(data)
+                    hasher.update(data)
+
+            for chunk in protocol.iter_data(conn, buffer):
+                received += len(chunk)
+                if decompressor:
+                    for data in fs_decompress(decompressor, chunk):
+                        write(data)
+                else:
+                    write(chunk)
+
+            if decompressor and hasattr(decompressor, "flush"):
+                write(decompressor.flush())
+
+            if writer:
+                writer.close()
+
+    return hasher.hexdigest(), received
+
+def fs_get_file(section, data, dest, conn):
+    logger = logging.getLogger("Syncropy")
+    cmdget = {
+        "context": "file",
+        "command": {
+            "name": "get",
+            "filename": data["name"],
+            "compress": fs_get_codec(section, data),
+            "sparse": True
+        }
+    }
+
+    response = protocol.request(conn, cmdget)
+    if response["result"] != "ok":
+        for _ in protocol.iter_frames(conn):
+            pass
+        logger.error(section["name"] + ": Cannot transfer file " + data["name"] + ": " + response["message"])
+        return None, 0
+
+    logger.debug(section["name"] + ": Transfer file " + data["name"] + " (codec " + response.get("codec", "none") + ")")
+
+    extents = protocol.recv_extents(conn) if "size" in response else None
+
+    return fs_receive(conn, dest, response.get("codec", "none"), section["compressed"],
+                      hasher=fs_get_hasher(data["attrs"].get("algorithm", "md5")),
+                      buffer_size=section.get("buffer_size", 2**22), extents=extents, size=response.get("size"))
+
+def fs_partial_path(cfg, section, data):
+    return os.sep.join([cfg["general"]["repository"], "store", "partial",
+                        section["name"] + "-" + data["attrs"]["hash"]])
+
+def fs_get_partial(cfg, section, data, conn):
+    logger = logging.getLogger("Syncropy")
+    partial = fs_partial_path(cfg, section, data)
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+
+    # Data received by an interrupted transfer is hashed again, the client
+    # checks it against its file before sending the rest
+    algorithm = data["attrs"].get("algorithm", "md5")
+    hasher = fs_get_hasher(algorithm)
+    offset = 0
+    if os.path.exists(partial):
+        with open(partial, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                hasher.update(chunk)
+                offset += len(chunk)
+
+    cmdget = {
+        "context": "file",
+        "command": {
+            "name": "get",
+            "filename": data["name"],
+            "compress": fs_get_codec(section, data),
+            "offset": offset,
+            "digest": hasher.hexdigest(),
+            "algorithm": algorithm,
+            "sparse": True
+        }
+    }
+
+    response = protocol.request(conn, cmdget)
+    if response["result"] != "ok":
+        for _ in protocol.iter_frames(conn):
+            pass
+        logger.error(section["name"] + ": Cannot transfer file " + data["name"] + ": " + response["message"])
+        if os.path.exists(partial):
+            os.remove(partial)
+        return None, 0
+
+    # Clients which can't resume send the whole file
+    if response.get("offset", 0) != offset:
+        offset = 0
+        hasher = fs_get_hasher(algorithm)
+    elif offset:
+        logger.debug(section["name"] + ": Resume file " + data["name"] + " from byte " + str(offset))
+
+    logger.debug(section["name"] + ": Transfer file " + data["name"] + " (codec " + response.get("codec", "none") + ")")
+
+    extents = protocol.recv_extents(conn) if "size" in response else None
+
+    return fs_receive(conn, partial, response.get("codec", "none"), False, offset, hasher,
+                      section.get("buffer_size", 2**22), extents, response.get("size"))
+
+def fs_block_size(size):
+    # Block size grows with the square root of the file, as rsync does
+    block = int(math.sqrt(size)) // 1024 * 1024
+    return min(max(block, 2048), 2**17)
+
+def fs_signatures(basis, block_size):
+    signatures = []
+
+    with open(basis, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                break
+
+            signatures.append(DELTA_SIGNATURE.pack(zlib.adler32(block), hashlib.md5(block).digest()))
+            if len(signatures) == 4096:
+                yield b"".join(signatures)
+                signatures = []
+
+    if signatures:
+        yield b"".join(signatures)
+
+def fs_rebuild(basis, dest, block_size, conn, hasher=None):
+    if hasher is None:
+        hasher = hashlib.md5()
+    received = 0
+
+    with open(basis, "rb") as source, open(dest, "wb") as destfile:
+        for instruction in protocol.iter_frames(conn):
+            received += len(instruction)
+            if instruction[:1] == b"C":
+                index, count = DELTA_COPY.unpack_from(instruction, 1)
+                source.seek(index * block_size)
+
+                remaining = count * block_size
+                while remaining > 0:
+                    data = source.read(min(remaining, 2**20))
                     if not data:
-                        break
+                        raise ValueError("Delta references a block outside of the previous copy")
                     destfile.write(data)
+                    hasher.update(data)
+                    remaining -= len(data)
+            elif instruction[:1] == b"L":
+                data = memoryview(instruction)[1:]
+                destfile.write(data)
+                hasher.update(data)
+            else:
+                raise ValueError("Unknown delta instruction")
+
+    return hasher.hexdigest(), received
+
+def fs_get_delta(cfg, section, data, item, dest, conn):
+    logger = logging.getLogger("Syncropy")
+    source = os.sep.join([fs_compute_destination(cfg, section, True), item])
+    basis = None
+
+    try:
+        if section["compressed"]:
+            if not os.path.exists(source + ".compressed"):
+                return None
+
+            # Blocks are read in random order, so previous copy is decompressed
+            basis = dest + ".basis"
+            with lzma.open(source + ".compressed") as src, open(basis, "wb") as destfile:
+                shutil.copyfileobj(src, destfile, 2**20)
+        else:
+            if not os.path.exists(source):
+                return None
+            basis = source
+
+        size = os.path.getsize(basis)
+        if size < section.get("delta_min_size", 2**20):
+            return None
+
+        block_size = fs_block_size(size)
+        cmddelta = {
+            "context": "file",
+            "command": {
+                "name": "delta",
+                "filename": data["name"],
+                "blocksize": block_size
+            }
+        }
+
+        protocol.send_message(conn, cmddelta)
+        for signatures in fs_signatures(basis, block_size):
+            protocol.send_frame(conn, signatures)
+        protocol.send_frame(conn)
+
+        response = protocol.recv_message(conn)
+        if response is None:
+            raise ConnectionError("Connection closed before the response")
+        elif response["result"] != "ok":
+            for _ in protocol.iter_frames(conn):
+                pass
+            logger.error(section["name"] + ": Cannot compute delta of " + data["name"] + ": " + response["message"])
+            return None
 
-            if section["compressed"]:
-                fs_compress_file(dest)
+        logger.debug(section["name"] + ": Transfer delta of " + data["name"])
+
+        digest, received = fs_rebuild(basis, dest, block_size, conn,
+                                      fs_get_hasher(data["attrs"].get("algorithm", "md5")))
+        if digest != data["attrs"]["hash"]:
+            # File is changed after listing, so it is transferred again
+            logger.warning(section["name"] + ": Rebuilt file " + data["name"] + " doesn't match its hash")
+            return None
+
+        return received
+    finally:
+        if basis and basis != source and os.path.exists(basis):
+            os.remove(basis)
+
+def fs_restore_path(data, target=None):
+    # Entries are restored to their path, or below the target directory
+    if not target:
+        return data["name"]
+
+    return target.rstrip("/") + "/" + fs_item_name(data).lstrip("/")
+
+def fs_put(cfg, section, data, conn, target=None):
+    attrs = data["attrs"]
+    source = fs_item_destination(cfg, section, data)[1]
+    codec = "none"
+
+    if attrs["type"] == "file" and attrs["compressed"]:
+        # Compressed copies are streamed as they are and decompressed by
+        # the client while written
+        source += ".compressed"
+        codec = "lzma"
+
+    cmdput = {
+        "context": "file",
+        "command": {
+            "name": "put",
+            "filename": fs_restore_path(data, target),
+            "codec": codec,
+            "attrs": dict([(key, attrs[key]) for key in ["type", "link", "mode", "user", "group", "mtime"]])
+        }
+    }
+    if "acl" in data:
+        cmdput["command"]["acl"] = data["acl"]
+
+    if attrs["type"] != "file":
+        protocol.send_message(conn, cmdput)
+        return 0
+
+    with open(source, "rb") as f:
+        protocol.send_message(conn, cmdput)
+
+        buffer = fs_buffer(section.get("buffer_size", 2**22))
+        if codec == "none":
+            return protocol.send_file(conn, f, buffer)
+
+        view = memoryview(buffer)
+        sent = 0
+        for count in iter(lambda: f.readinto(view), 0):
+            protocol.send_frame(conn, view[:count])
+            sent += count
+        protocol.send_frame(conn)
+
+    return sent
+
+def fs_put_result(section, conn):
+    logger = logging.getLogger("Syncropy")
+
+    response = protocol.recv_message(conn)
+    if response is None:
+        raise ConnectionError("Connection closed before the response")
+    for _ in protocol.iter_frames(conn):
+        pass
+
+    if response["result"] != "ok":
+        logger.error(section["name"] + ": Cannot restore " + response.get("name", "") + ": " + response["message"])
+
+    return response
 
 def fs_compress_file(path):
     with lzma.open(path + ".compressed", "w") as lzma_file, open(path, 'rb') as file_name:
@@ -192,66 +1089,437 @@ def fs_compress_file(path):
             lzma_file.write(line)
     os.remove(path)
 
-def fs_remove_dataset(cfg, grace, dataset):
-    dataset = os.sep.join([cfg["general"]["repository"], grace, str(dataset)])
-    if os.path.exists(dataset):
-        shutil.rmtree(dataset)
+def fs_trash_dataset(cfg, grace, dataset, run):
+    source = os.sep.join([cfg["general"]["repository"], grace, str(dataset)])
+    if not os.path.exists(source):
+        return None
+
+    # Dataset is only moved, its content is removed by reclamation
+    trash = os.sep.join([cfg["general"]["repository"], "trash"])
+    os.makedirs(trash, exist_ok=True)
+
+    dest = os.sep.join([trash, "-".join([grace, str(dataset), str(run)])])
+    os.rename(source, dest)
+
+    return dest
+
+def fs_throttle(started, count, rate):
+    if rate:
+        delay = count / rate - (time.time() - started)
+        if delay > 0:
+            time.sleep(delay)
+
+def fs_unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def fs_reclaim(path, workers=4, rate=0):
+    started = time.time()
+    count = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Tree is removed bottom-up, so it can be resumed if interrupted
+        for root, dirs, files in os.walk(path, topdown=False):
+            items = [os.path.join(root, item) for item in files]
+            items.extend([os.path.join(root, item) for item in dirs if os.path.islink(os.path.join(root, item))])
+
+            for chunk in range(0, len(items), 1000):
+                list(pool.map(fs_unlink, items[chunk:chunk + 1000]))
+                count += len(items[chunk:chunk + 1000])
+                fs_throttle(started, count, rate)
+
+            os.rmdir(root)
+            count += 1
+
+    return count
+
+def fs_reclaim_store(cfg, dbm, rate=0):
+    store = os.sep.join([cfg["general"]["repository"], "store"])
+    started = time.time()
+    count = 0
+    removed = []
+
+    if not os.path.exists(store):
+        return 0
+
+    for root, dirs, files in os.walk(store):
+        if root == store:
+            dirs[:] = [item for item in dirs if item not in ["tmp", "partial"]]
+
+        # MD5 contents are two levels below the store, the others three
+        parts = os.path.relpath(root, store).split(os.sep)
+        algorithm = parts[0] if len(parts) == 3 else "md5"
+
+        for item in files:
+            path = os.path.join(root, item)
+
+            # Content is referenced only by the store
+            if os.lstat(path).st_nlink == 1:
+                os.unlink(path)
+                removed.append((item, algorithm))
+                count += 1
+                fs_throttle(started, count, rate)
+
+        if len(removed) >= 1000:
+            db_del_store(dbm, removed)
+            removed = []
+
+    db_del_store(dbm, removed)
+
+    return count
+
+def fs_reclaim_partial(cfg, days=7):
+    partial = os.sep.join([cfg["general"]["repository"], "store", "partial"])
+    count = 0
+
+    if not os.path.exists(partial):
+        return 0
+
+    # Interrupted transfers not resumed in time are abandoned
+    limit = time.time() - days * 86400
+    for item in os.listdir(partial):
+        path = os.path.join(partial, item)
+        if os.lstat(path).st_mtime < limit:
+            fs_unlink(path)
+            count += 1
+
+    return count
 
 def db_get_last_dataset(cfg, grace):
 
     with Database(cfg) as dbs:
-        with closing(dbs.connection.cursor()) as cur:
-            cur.execute("SELECT actual FROM status WHERE grace = ?", [grace])
-            dataset = cur.fetchone()[0]
+        dataset = dbs.execute("SELECT actual FROM status WHERE grace = ?", [grace]).fetchone()[0]
 
     return dataset
 
 def db_set_last_dataset(cfg, grace, dataset):
     with Database(cfg) as dbm:
-        with closing(dbm.connection.cursor()) as cursor:
-            cursor.execute("UPDATE status SET actual = ?, last_run = CURRENT_TIMESTAMP WHERE grace = ?", [dataset, grace])
+        dbm.execute("UPDATE status SET actual = ?, last_run = CURRENT_TIMESTAMP WHERE grace = ?", [dataset, grace])
+
+def db_get_run(dbm, grace, dataset):
+    row = dbm.execute("SELECT run FROM runs WHERE grace = ? AND dataset = ?", [grace, dataset]).fetchone()
 
-def db_del_dataset(dbm, grace, dataset):
+    # Rows saved before runs were introduced use the dataset as run
+    if row:
+        return row[0]
+    else:
+        return dataset
+
+def db_new_run(dbm, cfg, grace, dataset):
     with closing(dbm.connection.cursor()) as cursor:
-        cursor.execute("DELETE FROM attrs WHERE grace = ? AND dataset = ?",
-                       [grace, dataset])
-        cursor.execute("DELETE FROM acls WHERE grace = ? AND dataset = ?",
-                       [grace, dataset])
+        cursor.execute("SELECT MAX(run) FROM runs WHERE grace = ?", [grace])
+        last = cursor.fetchone()[0] or 0
 
-def db_save_attrs(dbm, section, data):
-    # TODO: Add code for managing Windows systems
-
-    def save_posix_acl(cursor, acls):
-        for user in acls["user"]:
-            cursor.execute(" ".join(["INSERT INTO acls",
-                    "(area, grace, dataset, element, name, type, perms)",
-                    "VALUES(?, ?, ?, ?, ?, ?, ?)"]),
-                           [section["name"], section["grace"], section["dataset"], data["name"], user["uid"], "group", user["attrs"]])
-        for group in acls["group"]:
-            cursor.execute(" ".join(["INSERT INTO acls",
-                    "(area, grace, dataset, element, name, type, perms)",
-                    "VALUES(?, ?, ?, ?, ?, ?, ?)"]),
-                           [section["name"], section["grace"], section["dataset"], data["name"], group["gid"], "group", group["attrs"]])
+        if last <= int(cfg["dataset"][grace]):
+            # Identifiers must not overlap datasets saved before runs
+            cursor.execute("SELECT MAX(dataset) FROM entries WHERE grace = ?", [grace])
+            last = max(last, cursor.fetchone()[0] or 0, int(cfg["dataset"][grace]))
+
+        run = last + 1
+        cursor.execute("DELETE FROM runs WHERE grace = ? AND dataset = ?", [grace, dataset])
+        cursor.execute("INSERT INTO runs (grace, dataset, run) VALUES (?, ?, ?)", [grace, dataset, run])
+
+    return run
+
+def db_trash_run(dbm, grace, dataset, run, path):
+    with closing(dbm.connection.cursor()) as cursor:
+        if run or path:
+            cursor.execute("INSERT INTO trash (grace, run, path, removed) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                           [grace, run, path])
+
+        # Run 0 marks an empty dataset
+        cursor.execute("DELETE FROM runs WHERE grace = ? AND dataset = ?", [grace, dataset])
+        cursor.execute("INSERT INTO runs (grace, dataset, run) VALUES (?, ?, ?)", [grace, dataset, 0])
+
+def db_list_trash(dbm):
+    with closing(dbm.connection.cursor()) as cursor:
+        cursor.execute("SELECT grace, run, path FROM trash ORDER BY removed")
+        return cursor.fetchall()
+
+def db_del_run(dbm, grace, run):
+    with closing(dbm.connection.cursor()) as cursor:
+        cursor.execute("DELETE FROM entries WHERE grace = ? AND dataset = ?",
+                       [grace, run])
+        cursor.execute("DELETE FROM entry_acls WHERE grace = ? AND dataset = ?",
+                       [grace, run])
+        cursor.execute("DELETE FROM listings WHERE grace = ? AND dataset = ?",
+                       [grace, run])
+        cursor.execute("DELETE FROM journal_tokens WHERE grace = ? AND dataset = ?",
+                       [grace, run])
+        cursor.execute("DELETE FROM progress WHERE grace = ? AND dataset = ?",
+                       [grace, run])
+        cursor.execute("DELETE FROM trash WHERE grace = ? AND run = ?",
+                       [grace, run])
+
+def db_del_store(dbm, blobs):
+    rows = []
+    others = []
+    for item, algorithm in blobs:
+        if item.endswith(".compressed"):
+            row = [item[:-len(".compressed")], True]
+        else:
+            row = [item, False]
+
+        if _db_algorithm(algorithm):
+            others.append(row + [algorithm])
+        else:
+            rows.append(row)
+
+    with closing(dbm.connection.cursor()) as cursor:
+        if rows:
+            cursor.executemany("DELETE FROM store WHERE hash = ? AND compressed = ? AND algorithm IS NULL", rows)
+        if others:
+            cursor.executemany("DELETE FROM store WHERE hash = ? AND compressed = ? AND algorithm = ?", others)
+
+def db_purge_paths(dbm, size=1000):
+    # Paths are shared by every dataset of an area, so they are removed only
+    # when no entry refers to them. References are read once per area from
+    # the index of entries, instead of looking up every path
+    count = 0
 
     with closing(dbm.connection.cursor()) as cursor:
-        attrs = data["attrs"]
-        cursor.execute(" ".join(["INSERT INTO attrs",
-                    "(area, grace, dataset, element, os, username, groupname, type,",
-                    "link, mtime, ctime, hash, perms, compressed)",
-                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"]),
-                       [section["name"], section["grace"], section["dataset"], data["name"], data["os"],
-                        attrs["user"], attrs["group"], attrs["type"], attrs["link"], attrs["mtime"], attrs["ctime"],
-                        attrs["hash"], attrs["mode"], section["compressed"]])
-
-        if "acl" in data:
-            if data["os"] == "posix":
-                save_posix_acl(cursor, data["acl"])
+        cursor.execute("SELECT id FROM areas")
+        areas = [row[0] for row in cursor.fetchall()]
+
+        for area in areas:
+            cursor.execute("SELECT DISTINCT path FROM entries WHERE area = ?", [area])
+            used = set([row[0] for row in cursor])
+
+            cursor.execute("SELECT id FROM paths WHERE area = ?", [area])
+            unused = [[row[0]] for row in cursor.fetchall() if row[0] not in used]
+
+            for i in range(0, len(unused), size):
+                dbm.begin()
+                cursor.executemany("DELETE FROM paths WHERE id = ?", unused[i:i + size])
+                dbm.commit()
+            count += len(unused)
+
+    return count
+
+SQL_INSERT_ATTRS = " ".join(["INSERT INTO entries",
+                             "(area, grace, dataset, path, os, username, groupname, type,",
+                             "link, mtime, ctime, hash, perms, size, compressed, algorithm)",
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"])
+
+SQL_INSERT_ACLS = " ".join(["INSERT INTO entry_acls",
+                            "(area, grace, dataset, path, name, type, perms, scope)",
+                            "VALUES(?, ?, ?, ?, ?, ?, ?, ?)"])
+
+def _path_hash(element):
+    return hashlib.md5(element.encode("utf-8")).hexdigest()
+
+def _db_intern_names(dbm, cursor, table, sequence, names, cache):
+    missing = sorted(set([name for name in names if name is not None and name not in cache]))
+
+    for i in range(0, len(missing), LOOKUP_SIZE):
+        chunk = missing[i:i + LOOKUP_SIZE]
+        cursor.execute(" ".join(["SELECT id, name FROM", table,
+                                 "WHERE name IN (" + ", ".join(["?"] * len(chunk)) + ")",
+                                 "ORDER BY id"]), chunk)
+        for key, name in cursor.fetchall():
+            cache.setdefault(name, key)
+
+    missing = [name for name in missing if name not in cache]
+    if missing:
+        rows = []
+        for key, name in zip(dbm.reserve_ids(cursor, sequence, len(missing)), missing):
+            cache[name] = key
+            rows.append([key, name])
+        cursor.executemany("INSERT INTO " + table + " (id, name) VALUES (?, ?)", rows)
+
+def _db_intern_paths(dbm, cursor, area, elements, cache):
+    missing = {}
+    for element in elements:
+        if element not in cache:
+            missing[_path_hash(element)] = element
+
+    hashes = sorted(missing)
+    for i in range(0, len(hashes), LOOKUP_SIZE):
+        chunk = hashes[i:i + LOOKUP_SIZE]
+        cursor.execute(" ".join(["SELECT id, hash, element FROM paths",
+                                 "WHERE area = ? AND hash IN (" + ", ".join(["?"] * len(chunk)) + ")",
+                                 "ORDER BY id"]), [area] + chunk)
+        for key, hashed, element in cursor.fetchall():
+            if missing.get(hashed.strip()) == element:
+                cache.setdefault(element, key)
+
+    missing = [(hashed, element) for hashed, element in missing.items() if element not in cache]
+    if missing:
+        rows = []
+        for key, (hashed, element) in zip(dbm.reserve_ids(cursor, "seq_paths", len(missing)), missing):
+            cache[element] = key
+            rows.append([key, area, hashed, element])
+        cursor.executemany("INSERT INTO paths (id, area, hash, element) VALUES (?, ?, ?, ?)", rows)
+
+def _owner_name(value):
+    # Unknown owners are sent as numeric identifiers
+    if value is None:
+        return None
+
+    return str(value)
+
+def _db_algorithm(name):
+    # MD5 digests are saved without algorithm, as before it was selectable
+    if not name or name == "md5":
+        return None
+
+    return name
+
+def _db_get_area(cursor, name):
+    cursor.execute("SELECT MIN(id) FROM areas WHERE name = ?", [name])
+    return cursor.fetchone()[0]
+
+class AttrsWriter(object):
+    _dbm = None
+    _section = None
+    _size = None
+    _cursor = None
+    _lookup = None
+
+    def __init__(self, dbm, section, size=1000):
+        self._dbm = dbm
+        self._section = section
+        self._size = size
+        self._attrs = []
+        self._acls = []
+        self._areas = {}
+        self._owners = {}
+
+        self._cursor = dbm.connection.cursor()
+        self._insert_attrs = dbm.prepare(self._cursor, SQL_INSERT_ATTRS)
+        self._insert_acls = dbm.prepare(self._cursor, SQL_INSERT_ACLS)
+        self._lookup = dbm.connection.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if not exc_type:
+                self.flush()
+        finally:
+            self._lookup.close()
+            self._cursor.close()
+
+    def save(self, data, section=None):
+        section = section or self._section
+        self._attrs.append((section, data))
+
+        # TODO: Add code for managing Windows systems
+        if "acl" in data and data["os"] == "posix":
+            for user in data["acl"]["user"]:
+                self.save_acl(section, data["name"], user["uid"], "user", user["attrs"])
+            for group in data["acl"]["group"]:
+                self.save_acl(section, data["name"], group["gid"], "group", group["attrs"])
+
+            # Default ACL of a directory, inherited by the entries created in it
+            default = data["acl"].get("default") or {}
+            for user in default.get("user", []):
+                self.save_acl(section, data["name"], user["uid"], "user", user["attrs"], "default")
+            for group in default.get("group", []):
+                self.save_acl(section, data["name"], group["gid"], "group", group["attrs"], "default")
+
+        if len(self._attrs) >= self._size:
+            self.flush()
+
+    def save_acl(self, section, element, name, acltype, perms, scope=None):
+        self._acls.append((section, element, name, acltype, perms, scope))
+
+        if len(self._acls) >= self._size * 4:
+            self.flush()
+
+    def _intern(self):
+        cursor = self._lookup
+        owners = []
+        elements = {}
+
+        for section, data in self._attrs:
+            owners.extend([_owner_name(data["attrs"]["user"]), _owner_name(data["attrs"]["group"])])
+            elements.setdefault(section["name"], set()).add(data["name"])
+        for section, element, name, acltype, perms, scope in self._acls:
+            owners.append(_owner_name(name))
+            elements.setdefault(section["name"], set()).add(element)
+
+        _db_intern_names(self._dbm, cursor, "areas", "seq_areas", elements.keys(), self._areas)
+        _db_intern_names(self._dbm, cursor, "owners", "seq_owners", owners, self._owners)
+
+        # Path identifiers are only needed by the current batch
+        paths = {}
+        for area, names in elements.items():
+            paths[area] = {}
+            _db_intern_paths(self._dbm, cursor, self._areas[area], names, paths[area])
+
+        return paths
+
+    def flush(self):
+        if self._attrs or self._acls:
+            self._dbm.begin()
+            paths = self._intern()
+
+            rows = []
+            for section, data in self._attrs:
+                attrs = data["attrs"]
+                rows.append([self._areas[section["name"]], section["grace"], section["run"],
+                             paths[section["name"]][data["name"]], data["os"],
+                             self._owners.get(_owner_name(attrs["user"])), self._owners.get(_owner_name(attrs["group"])),
+                             attrs["type"], attrs["link"], attrs["mtime"], attrs["ctime"],
+                             attrs["hash"], attrs["mode"], attrs.get("size"), section["compressed"],
+                             _db_algorithm(attrs.get("algorithm"))])
+            if rows:
+                self._cursor.executemany(self._insert_attrs, rows)
+
+            rows = []
+            for section, element, name, acltype, perms, scope in self._acls:
+                rows.append([self._areas[section["name"]], section["grace"], section["run"],
+                             paths[section["name"]][element], self._owners.get(_owner_name(name)), acltype, perms,
+                             scope])
+            if rows:
+                self._cursor.executemany(self._insert_acls, rows)
+
+        # Retaining commit keeps the prepared statements valid for the next batch
+        self._dbm.commit(retaining=True)
+
+        self._attrs = []
+        self._acls = []
+
+def db_save_history(dbm, grace, dataset, summary):
+    dbm.execute(" ".join(["INSERT INTO history",
+                          "(area, grace, dataset, started, duration, bytes, files, result)",
+                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"]),
+                [summary["name"], grace, dataset, summary["started"], summary["duration"],
+                 summary["bytes"], summary["files"], summary["result"]])
+
+def db_get_durations(dbm, days=30):
+    since = datetime.datetime.now() - datetime.timedelta(days=days)
+
+    with closing(dbm.connection.cursor()) as cursor:
+        cursor.execute(" ".join(["SELECT area, AVG(duration) FROM history",
+                                 "WHERE started >= ? AND result = ? GROUP BY area"]),
+                       [since, "ok"])
+        result = {}
+        for area, duration in cursor.fetchall():
+            result[area] = duration
+
+    return result
+
+def db_save_store(dbm, hashed, compressed, algorithm=None):
+    dbm.execute("INSERT INTO store (hash, compressed, stored, algorithm) VALUES (?, ?, CURRENT_TIMESTAMP, ?)",
+                [hashed, compressed, _db_algorithm(algorithm)])
+
+def db_save_attrs(dbm, section, data):
+    with AttrsWriter(dbm, section, 1) as writer:
+        writer.save(data)
 
 def db_list_items(dbm, section, itemtype):
     with closing(dbm.connection.cursor()) as cursor:
-        cursor.execute(" ".join(["SELECT element, os, hash, type, link",
-                                 "FROM attrs WHERE type = ? AND area = ? AND grace = ? AND dataset = ?"]),
-            [itemtype, section["name"], section["grace"], section["dataset"]])
+        area = _db_get_area(cursor, section["name"])
+
+        cursor.execute(" ".join(["SELECT p.element, e.os, e.hash, e.type, e.link",
+                                 "FROM entries e JOIN paths p ON p.id = e.path",
+                                 "WHERE e.type = ? AND e.area = ? AND e.grace = ? AND e.dataset = ?"]),
+            [itemtype, area, section["grace"], section["run"]])
 
         for item in cursor.fetchall():
             result = {
@@ -265,21 +1533,321 @@ def db_list_items(dbm, section, itemtype):
             }
             yield result
 
+def _db_prefix_filter(dbm, cursor, area, section, prefix):
+    # Entries under the prefix are selected by the database
+    if not prefix:
+        return "", []
+
+    cursor.execute("SELECT MIN(os) FROM entries WHERE area = ? AND grace = ? AND dataset = ?",
+                   [area, section["grace"], section["run"]])
+    separator = "\\" if cursor.fetchone()[0] == "nt" else "/"
+
+    element = prefix.rstrip("/\\")
+    return (" AND (p.element = ? OR " + dbm.backend.starts_with("p.element", "?") + ")",
+            [element or prefix, element + separator])
+
+def db_list_restore(dbm, section, prefix=None):
+    with closing(dbm.connection.cursor()) as cursor:
+        area = _db_get_area(cursor, section["name"])
+        predicate, params = _db_prefix_filter(dbm, cursor, area, section, prefix)
+
+        # Entries of ACLs are collected first, by path (the owning group has no name)
+        acls = {}
+        cursor.execute(" ".join(["SELECT a.path, o.name, a.type, a.perms, a.scope",
+                                 "FROM entry_acls a JOIN paths p ON p.id = a.path",
+                                 "LEFT JOIN owners o ON o.id = a.name",
+                                 "WHERE a.area = ? AND a.grace = ? AND a.dataset = ?" + predicate]),
+                       [area, section["grace"], section["run"]] + params)
+        for path, name, acltype, perms, scope in cursor:
+            acl = acls.setdefault(path, {"user": [], "group": []})
+            if scope == "default":
+                acl = acl.setdefault("default", {"user": [], "group": []})
+            if acltype == "user":
+                acl["user"].append({"uid": name, "attrs": perms})
+            else:
+                acl["group"].append({"gid": name, "attrs": perms})
+
+        cursor.execute(" ".join(["SELECT p.element, e.os, e.type, e.link, e.hash, e.perms, u.name, g.name,",
+                                 "e.mtime, e.size, e.compressed, e.path",
+                                 "FROM entries e JOIN paths p ON p.id = e.path",
+                                 "LEFT JOIN owners u ON u.id = e.username",
+                                 "LEFT JOIN owners g ON g.id = e.groupname",
+                                 "WHERE e.area = ? AND e.grace = ? AND e.dataset = ?" + predicate]),
+                       [area, section["grace"], section["run"]] + params)
+
+        for element, system, itemtype, link, hashed, mode, user, group, mtime, size, compressed, path in cursor:
+            item = {
+                "name": element,
+                "os": system,
+                "attrs": {
+                    "type": itemtype,
+                    "link": link,
+                    "hash": hashed,
+                    "mode": mode,
+                    "user": user,
+                    "group": group,
+                    "mtime": mtime,
+                    "size": size,
+                    "compressed": bool(compressed)
+                }
+            }
+            if path in acls:
+                item["acl"] = acls[path]
+
+            yield item
+
 def db_item_exist(dbm, section, item, previous=None):
     if previous:
         dataset = previous
     else:
-        dataset = section["dataset"]
+        dataset = section["run"]
+
+    items = dbm.execute(" ".join(["SELECT count(e.path) FROM entries e",
+                                  "JOIN areas a ON a.id = e.area JOIN paths p ON p.id = e.path",
+                                  "WHERE a.name = ? AND p.area = e.area AND p.hash = ? AND p.element = ?",
+                                  "AND e.hash = ? AND e.grace = ? AND e.dataset = ?"]),
+                        [section["name"], _path_hash(item["name"]), item["name"], item["attrs"]["hash"],
+                         section["grace"], dataset]).fetchone()
 
+    if items[0] > 0:
+        return True
+    else:
+        return False
+
+def db_diff_items(dbm, section, previous):
+    # Paths are interned, so the previous run is matched on the integer key
+    # by the database instead of comparing the elements
     with closing(dbm.connection.cursor()) as cursor:
-        cursor.execute(" ".join(["SELECT count(element) FROM attrs",
-                                 "WHERE element = ? AND hash = ?",
-                                 " AND area = ? AND grace = ? AND dataset = ?"]),
-                       [item["name"], item["attrs"]["hash"], section["name"], section["grace"], dataset])
+        area = _db_get_area(cursor, section["name"])
+
+        cursor.execute(" ".join(["SELECT p.element, c.os, c.hash, c.type, c.link, c.size, c.path, c.algorithm,",
+                                 "v.hash, v.algorithm",
+                                 "FROM entries c JOIN paths p ON p.id = c.path",
+                                 "LEFT JOIN entries v ON v.area = c.area AND v.grace = c.grace",
+                                 "AND v.dataset = ? AND v.path = c.path AND v.type = c.type",
+                                 "WHERE c.type = ? AND c.area = ? AND c.grace = ? AND c.dataset = ?"]),
+                       [previous, "file", area, section["grace"], section["run"]])
 
-        items = cursor.fetchone()
+        for element, system, hashed, itemtype, link, size, path, algorithm, last, previous in cursor:
+            item = {
+                "name": element,
+                "os": system,
+                "path": path,
+                "attrs": {
+                    "hash": hashed,
+                    "type": itemtype,
+                    "link": link,
+                    "size": size,
+                    "algorithm": algorithm or "md5"
+                }
+            }
+
+            # Digests of different algorithms can't be compared
+            if last is None:
+                yield "new", item
+            elif last == hashed and previous == algorithm:
+                yield "unchanged", item
+            else:
+                yield "changed", item
+
+def db_migrate(dbm, size=1000):
+    logger = logging.getLogger("Syncropy")
+
+    if dbm.version >= SCHEMA_VERSION:
+        return 0
+
+    dbm.create_catalog()
+
+    # Rows left by an interrupted migration are converted again
+    with closing(dbm.connection.cursor()) as cursor:
+        cursor.execute("DELETE FROM entries")
+        cursor.execute("DELETE FROM entry_acls")
+    dbm.commit()
 
-        if items[0] > 0:
+    count = 0
+    with AttrsWriter(dbm, None, size) as writer, closing(dbm.connection.cursor()) as cursor:
+        cursor.execute(" ".join(["SELECT area, grace, dataset, element, os, username, groupname, type,",
+                                 "link, mtime, ctime, hash, perms, compressed FROM attrs"]))
+
+        for row in cursor:
+            section = {"name": row[0], "grace": row[1], "run": row[2], "compressed": row[13]}
+            data = {
+                "name": row[3],
+                "os": row[4],
+                "attrs": {
+                    "user": row[5],
+                    "group": row[6],
+                    "type": row[7],
+                    "link": row[8],
+                    "mtime": row[9],
+                    "ctime": row[10],
+                    "hash": row[11],
+                    "mode": row[12]
+                }
+            }
+            writer.save(data, section)
+
+            count += 1
+            if count % 100000 == 0:
+                logger.info("Migrated " + str(count) + " catalog rows")
+
+        cursor.execute("SELECT area, grace, dataset, element, name, type, perms FROM acls")
+        for row in cursor:
+            section = {"name": row[0], "grace": row[1], "run": row[2]}
+            writer.save_acl(section, row[3], row[4], row[5], row[6])
+
+    with closing(dbm.connection.cursor()) as cursor:
+        cursor.execute("DROP TABLE acls")
+        cursor.execute("DROP TABLE attrs")
+    dbm.commit()
+
+    dbm.set_version(SCHEMA_VERSION)
+
+    return count
+
+def db_set_listed(dbm, section, token=None):
+    dbm.execute("INSERT INTO listings (area, grace, dataset, listed) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                [section["name"], section["grace"], section["run"]])
+
+    if token:
+        dbm.execute("INSERT INTO journal_tokens (area, grace, dataset, token) VALUES (?, ?, ?, ?)",
+                    [section["name"], section["grace"], section["run"], token])
+
+def db_is_listed(dbm, section):
+    row = dbm.execute("SELECT COUNT(*) FROM listings WHERE area = ? AND grace = ? AND dataset = ?",
+                      [section["name"], section["grace"], section["run"]]).fetchone()
+
+    return row[0] > 0
+
+def db_del_items(dbm, section):
+    # Rows saved by an interrupted listing are replaced by the new one
+    with closing(dbm.connection.cursor()) as cursor:
+        area = _db_get_area(cursor, section["name"])
+        if area is not None:
+            cursor.execute("DELETE FROM entries WHERE area = ? AND grace = ? AND dataset = ?",
+                           [area, section["grace"], section["run"]])
+            cursor.execute("DELETE FROM entry_acls WHERE area = ? AND grace = ? AND dataset = ?",
+                           [area, section["grace"], section["run"]])
+
+        for table in ["journal_tokens", "progress"]:
+            cursor.execute("DELETE FROM " + table + " WHERE area = ? AND grace = ? AND dataset = ?",
+                           [section["name"], section["grace"], section["run"]])
+
+    dbm.commit(retaining=True)
+
+def db_get_progress(dbm, section):
+    with closing(dbm.connection.cursor()) as cursor:
+        cursor.execute("SELECT path FROM progress WHERE area = ? AND grace = ? AND dataset = ?",
+                       [section["name"], section["grace"], section["run"]])
+
+        return set([row[0] for row in cursor])
+
+def db_set_progress(dbm, section, items):
+    if not items:
+        return
+
+    dbm.begin()
+    with closing(dbm.connection.cursor()) as cursor:
+        cursor.executemany(" ".join(["INSERT INTO progress (area, grace, dataset, path, bytes, saved)",
+                                     "VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)"]),
+                           [[section["name"], section["grace"], section["run"], path, size]
+                            for path, size in items])
+    dbm.commit(retaining=True)
+
+def db_get_token(dbm, section, previous):
+    row = dbm.execute("SELECT MAX(token) FROM journal_tokens WHERE area = ? AND grace = ? AND dataset = ?",
+                      [section["name"], section["grace"], previous]).fetchone()
+
+    return row[0]
+
+def db_get_digests(dbm, section, previous):
+    result = {}
+
+    with closing(dbm.connection.cursor()) as cursor:
+        # Digests of an interrupted listing don't cover all the entries saved
+        cursor.execute("SELECT COUNT(*) FROM listings WHERE area = ? AND grace = ? AND dataset = ?",
+                       [section["name"], section["grace"], previous])
+        if cursor.fetchone()[0] == 0:
+            return result
+
+        area = _db_get_area(cursor, section["name"])
+        cursor.execute(" ".join(["SELECT p.element, e.hash",
+                                 "FROM entries e JOIN paths p ON p.id = e.path",
+                                 "WHERE e.type = ? AND e.area = ? AND e.grace = ? AND e.dataset = ?"]),
+                       ["directory", area, section["grace"], previous])
+
+        for element, digest in cursor:
+            if digest:
+                result[element] = digest
+
+    return result
+
+def _db_covered(element, separator, roots):
+    # Unchanged directories are listed again, only their content is copied
+    index = element.find(separator)
+    while index >= 0:
+        if element[:index] in roots or (index + 1 < len(element) and element[:index + 1] in roots):
             return True
-        else:
-            return False
\ No newline at end of file
+        index = element.find(separator, index + 1)
+
+    return False
+
+def db_copy_items(dbm, section, previous, size=1000, unchanged=None, changed=None, trees=None):
+    # Content of unchanged directories is copied, or everything but the
+    # changed paths and trees. Paths are selected looking up their ancestors
+    # in the roots, then rows are copied by the database joining their ids
+    if unchanged is not None:
+        unchanged = set(unchanged)
+        select = lambda element, separator: _db_covered(element, separator, unchanged)
+    else:
+        changed = set(changed or [])
+        trees = set(trees or [])
+        select = lambda element, separator: (element not in changed and element not in trees and
+                                             not _db_covered(element, separator, trees))
+
+    with closing(dbm.connection.cursor()) as cursor, closing(dbm.connection.cursor()) as writer:
+        area = _db_get_area(cursor, section["name"])
+        key = [area, section["grace"], section["run"]]
+
+        dbm.begin()
+        writer.execute("DELETE FROM copy_paths WHERE area = ? AND grace = ? AND dataset = ?", key)
+
+        cursor.execute(" ".join(["SELECT DISTINCT e.path, p.element, e.os",
+                                 "FROM entries e JOIN paths p ON p.id = e.path",
+                                 "WHERE e.area = ? AND e.grace = ? AND e.dataset = ?"]),
+                       [area, section["grace"], previous])
+
+        rows = []
+        for path, element, system in cursor:
+            if select(element, "\\" if system == "nt" else "/"):
+                rows.append(key + [path])
+
+            if len(rows) >= size:
+                writer.executemany("INSERT INTO copy_paths (area, grace, dataset, path) VALUES (?, ?, ?, ?)", rows)
+                rows = []
+        if rows:
+            writer.executemany("INSERT INTO copy_paths (area, grace, dataset, path) VALUES (?, ?, ?, ?)", rows)
+
+        # Selected ids are unique, so every row of the previous dataset is
+        # copied once with its own compression flag
+        joined = " ".join(["JOIN copy_paths c ON c.path = {0}.path",
+                           "WHERE {0}.area = ? AND {0}.grace = ? AND {0}.dataset = ?",
+                           "AND c.area = ? AND c.grace = ? AND c.dataset = ?"])
+        writer.execute(" ".join(["INSERT INTO entry_acls (area, grace, dataset, path, name, type, perms, scope)",
+                                 "SELECT a.area, a.grace, CAST(? AS INTEGER), a.path, a.name, a.type, a.perms, a.scope",
+                                 "FROM entry_acls a", joined.format("a")]),
+                       [section["run"], area, section["grace"], previous] + key)
+
+        writer.execute(" ".join(["INSERT INTO entries",
+                                 "(area, grace, dataset, path, os, username, groupname, type,",
+                                 "link, mtime, ctime, hash, perms, size, compressed, algorithm)",
+                                 "SELECT e.area, e.grace, CAST(? AS INTEGER), e.path, e.os, e.username, e.groupname,",
+                                 "e.type, e.link, e.mtime, e.ctime, e.hash, e.perms, e.size, e.compressed, e.algorithm",
+                                 "FROM entries e", joined.format("e")]),
+                       [section["run"], area, section["grace"], previous] + key)
+        count = writer.rowcount
+
+        writer.execute("DELETE FROM copy_paths WHERE area = ? AND grace = ? AND dataset = ?", key)
+        dbm.commit(retaining=True)
+
+    return count
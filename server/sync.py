@@ -25,22 +25,31 @@ Section:
 
 __author__ = "enrico"
 
+import datetime
 import json
 import logging
 import pickle
+import queue
 import socket
 import ssl
 import sys
+import time
 from contextlib import closing
 
+import protocol
 import storage
 
-def get_remote_conn(cfg, section):
+# SSL contexts are reused by every connection opened from the same process
+_contexts = {}
+
+def get_ssl_context(cfg, section):
     logger = logging.getLogger("Syncropy")
-    if cfg[section].getboolean("ssl"):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    key = (cfg[section]["sslpem"], cfg[section]["sslpass"])
 
+    if key not in _contexts:
         context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        # Restored files are sent with sendfile when the kernel offloads TLS
+        context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
         try:
             context.load_cert_chain(
                 certfile=cfg[section]["sslpem"],
@@ -50,7 +59,15 @@ def get_remote_conn(cfg, section):
             logger.fatal("PEM key not found in " + cfg[section]["sslpem"])
             sys.exit(4)
 
-        conn = context.wrap_socket(sock)
+        _contexts[key] = context
+
+    return _contexts[key]
+
+def get_remote_conn(cfg, section):
+    logger = logging.getLogger("Syncropy")
+    if cfg[section].getboolean("ssl"):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn = get_ssl_context(cfg, section).wrap_socket(sock)
     else:
         conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     logger.debug(section + ": Socket created")
@@ -66,52 +83,306 @@ def get_remote_conn(cfg, section):
 
     return conn
 
+def get_session(cfg, section):
+    logger = logging.getLogger("Syncropy")
+    cmdsession = {
+        "context": "system",
+        "command": {
+            "name": "session"
+        }
+    }
+
+    conn = get_remote_conn(cfg, section)
+    try:
+        conn.send(json.dumps(cmdsession).encode("utf-8"))
+
+        response = protocol.recv_message(conn)
+        if response is None or response["result"] != "ok":
+            raise ConnectionError(section + ": session not accepted by the client")
+    except:
+        conn.close()
+        raise
+
+    logger.debug(section + ": Session opened")
+    return conn
+
+def close_session(conn):
+    cmdexit = {
+        "context": "system",
+        "command": {
+            "name": "exit"
+        }
+    }
+
+    try:
+        protocol.send_message(conn, cmdexit)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
 def fs_get_metadata(cfg, section):
     logger = logging.getLogger("Syncropy")
+    algorithm = section.get("algorithm", "md5")
+    storage.fs_get_hasher(algorithm)
+
     cmdlist = {
         "context": "file",
         "command": {
             "name": "list",
             "directory": cfg[section["name"]]["path"].split(","),
-            "acl": cfg[section["name"]].getboolean("acl")
+            "acl": cfg[section["name"]].getboolean("acl"),
+            "formats": ["binary", "json"],
+            "digests": section.get("digests", False),
+            "algorithms": [algorithm] if algorithm == "md5" else [algorithm, "md5"]
         }
     }
 
+    batch = cfg.getint("database", "batch_size", fallback=1000)
+    unchanged = []
+    changed = []
+    trees = []
+
+    if section.get("resume"):
+        with storage.Database(cfg) as dbs:
+            if storage.db_is_listed(dbs, section):
+                logger.debug(section["name"] + ": Listing of the interrupted run is reused")
+                return
+
+            storage.db_del_items(dbs, section)
+
     with closing(get_remote_conn(cfg, section["name"])) as conn, storage.Database(cfg) as dbs:
+        # Client with a journal lists only the changes since the previous listing
+        since = storage.db_get_token(dbs, section, section["previous_run"])
+        if since:
+            cmdlist["command"]["since"] = since
+
         conn.send(json.dumps(cmdlist).encode("utf-8"))
         logger.debug(section["name"] + ": JSON command list sended")
 
-        f = conn.makefile()
-        for data in f:
-            response = json.loads(data)
-            storage.db_save_attrs(dbs, section, response)
+        f = conn.makefile("rb")
+        header = protocol.recv_list_header(f)
+
+        # Clients which can't choose hash with MD5
+        algorithm = header.get("algorithm", "md5") if header else "md5"
+        storage.fs_get_hasher(algorithm)
+        if algorithm != section.get("algorithm", "md5"):
+            logger.warning(section["name"] + ": Client hashes files with " + algorithm)
+
+        if header and header.get("digests"):
+            digests = storage.db_get_digests(dbs, section, section["previous_run"])
+            protocol.send_digests(conn, digests)
+            logger.debug(section["name"] + ": " + str(len(digests)) + " directory digests sended")
+
+        with storage.AttrsWriter(dbs, section, batch) as writer:
+            for response in protocol.iter_list(f, header):
+                if response["result"] == "unchanged":
+                    unchanged.append(response["name"])
+                elif response["result"] == "changed":
+                    changed.append(response["name"])
+                elif response["result"] == "tree":
+                    trees.append(response["name"])
+                else:
+                    if response["attrs"]["type"] == "file":
+                        response["attrs"]["algorithm"] = algorithm
+                    writer.save(response)
 
         logger.debug(section["name"] + ": JSON list readed")
 
+        if header and header.get("changes"):
+            count = storage.db_copy_items(dbs, section, section["previous_run"], batch,
+                                          changed=changed, trees=trees)
+            logger.debug(section["name"] + ": " + str(len(changed) + len(trees)) + " changes listed, " +
+                         str(count) + " entries copied from previous dataset")
+        elif unchanged:
+            count = storage.db_copy_items(dbs, section, section["previous_run"], batch, unchanged=unchanged)
+            logger.debug(section["name"] + ": " + str(count) + " entries of " + str(len(unchanged)) +
+                         " unchanged directories copied from previous dataset")
+
+        storage.db_set_listed(dbs, section, header.get("token") if header else None)
+
+def fs_batched(section, state, item):
+    size = item["attrs"].get("size")
+
+    if not section.get("batch_files") or item["attrs"]["type"] != "file" or size is None:
+        return False
+    elif state == "changed" and section.get("delta") and size >= section.get("delta_min_size", 2**20):
+        return False
+
+    return size <= section.get("batch_file_size", 2**16)
+
 def fs_get_data(cfg, section):
-    if (section["dataset"] - 1) == 0:
-        previous = int(cfg["dataset"][section["grace"]])
-    else:
-        previous = section["dataset"] - 1
+    logger = logging.getLogger("Syncropy")
+
+    stats = {
+        "files": 0,
+        "bytes": 0
+    }
+
+    batch = cfg.getint("database", "batch_size", fallback=1000)
+    completed = set()
+    saved = []
+    flushed = time.time()
+
+    # Small files are requested together, until the client refuses it
+    pending = []
+    pending_bytes = 0
+    batched = True
 
+    conn = None
     with storage.Database(cfg) as dbs:
+        if section.get("resume"):
+            completed = storage.db_get_progress(dbs, section)
+            logger.debug(section["name"] + ": " + str(len(completed)) + " files saved by the interrupted run")
+
         for item in storage.db_list_items(dbs, section, "directory"):
             try:
                 storage.fs_save(cfg, section, item)
             except FileExistsError:
                 pass
-        for item in storage.db_list_items(dbs, section, "file"):
-            if storage.db_item_exist(dbs, section, item, previous):
-                storage.fs_save(cfg, section, item, previous=True)
-            else:
-                with closing(get_remote_conn(cfg, section["name"])) as conn:
-                    storage.fs_save(cfg, section, item, conn=conn)
+
+        def connect():
+            nonlocal conn
+
+            # Files are transferred through a single session per section,
+            # opened only if some content isn't already in store
+            if not conn:
+                conn = get_session(cfg, section["name"])
+            return conn
+
+        def flush():
+            nonlocal batched, pending_bytes
+
+            result = storage.fs_save_batch(cfg, section, pending, connect(), dbm=dbs)
+            if result is None:
+                batched = False
+                result = [storage.fs_save(cfg, section, item, conn=conn, dbm=dbs, connect=connect)
+                          for item in pending]
+
+            for item, received in zip(pending, result):
+                if received is None:
+                    # Not saved, so a reload of the run transfers it again
+                    continue
+                stats["bytes"] += received
+                saved.append((item["path"], received))
+
+            pending.clear()
+            pending_bytes = 0
+
+        try:
+            for state, item in storage.db_diff_items(dbs, section, section["previous_run"]):
+                if item["path"] in completed:
+                    continue
+
+                stats["files"] += 1
+                received = None
+
+                if state == "unchanged":
+                    try:
+                        received = storage.fs_save(cfg, section, item, previous=True, dbm=dbs)
+                    except FileNotFoundError:
+                        logger.warning(section["name"] + ": Previous copy of " + item["name"] + " not found")
+
+                if received is None and batched and fs_batched(section, state, item):
+                    if any([data["attrs"]["hash"] == item["attrs"]["hash"] for data in pending]):
+                        # Same content is received once, then linked from store
+                        flush()
+                    elif not storage.fs_in_store(cfg, section, item):
+                        pending.append(item)
+                        pending_bytes += item["attrs"]["size"]
+                        if len(pending) >= section["batch_files"] or pending_bytes >= section["batch_bytes"]:
+                            flush()
+                        continue
+
+                if received is None:
+                    received = storage.fs_save(cfg, section, item, conn=conn, dbm=dbs, connect=connect,
+                                               delta=(state == "changed" and section.get("delta", False)))
+                    if received is None:
+                        # Not saved, so a reload of the run transfers it again
+                        continue
+                    stats["bytes"] += received
+
+                # Saved files are recorded, so that a reload of the run skips them
+                saved.append((item["path"], received))
+                if len(saved) >= batch or time.time() - flushed >= 10:
+                    storage.db_set_progress(dbs, section, saved)
+                    saved = []
+                    flushed = time.time()
+
+            if pending:
+                flush()
+        finally:
+            if conn:
+                close_session(conn)
+            storage.db_set_progress(dbs, section, saved)
 
         for item in storage.db_list_items(dbs, section, "symlink"):
+            try:
                 storage.fs_save(cfg, section, item)
+            except FileExistsError:
+                pass
+
+    return stats
+
+def fs_put_data(cfg, section, items, target=None, window=64):
+    logger = logging.getLogger("Syncropy")
+
+    stats = {
+        "files": 0,
+        "bytes": 0,
+        "sent": 0,
+        "errors": 0
+    }
+
+    def result():
+        response = storage.fs_put_result(section, conn)
+        if response["result"] == "ok":
+            stats["files"] += 1
+            stats["bytes"] += response.get("size", 0)
+        else:
+            stats["errors"] += 1
+
+    # Entries are taken from the queue shared by every connection, and up to
+    # window of them are sent before waiting their results
+    conn = get_session(cfg, section["name"])
+    pending = 0
+    try:
+        while True:
+            try:
+                item = items.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                stats["sent"] += storage.fs_put(cfg, section, item, conn, target)
+            except FileNotFoundError:
+                logger.error(section["name"] + ": Saved copy of " + item["name"] + " not found")
+                stats["errors"] += 1
+                continue
+
+            pending += 1
+            if pending > window:
+                result()
+                pending -= 1
+
+        while pending:
+            result()
+            pending -= 1
+    finally:
+        close_session(conn)
+
+    return stats
 
 def fs_start(conf, process):
     error = False
+    summary = {
+        "name": None,
+        "result": "ko",
+        "started": datetime.datetime.now(),
+        "duration": 0,
+        "files": 0,
+        "bytes": 0
+    }
 
     def exec_remote_cmd(command):
         if not command == "":
@@ -136,6 +407,7 @@ def fs_start(conf, process):
     logger = logging.getLogger("Syncropy")
 
     logger.info("About to execute " + section["name"])
+    summary["name"] = section["name"]
 
     if "pre_command" in cfg[section["name"]]:
         try:
@@ -148,7 +420,8 @@ def fs_start(conf, process):
     if not error:
         try:
             fs_get_metadata(cfg, section)
-            fs_get_data(cfg, section)
+            summary.update(fs_get_data(cfg, section))
+            summary["result"] = "ok"
         except Exception as err:
             logger.error("Sync for {0} failed: {1}".format(section["name"], err))
             logger.exception("Exception Traceback")
@@ -160,4 +433,7 @@ def fs_start(conf, process):
             logger.error("Post command for {0} failed: {1}".format(section["name"], err))
             logger.exception("Exception Traceback")
 
-    logger.debug(section["name"] + ": Sync done")
\ No newline at end of file
+    summary["duration"] = (datetime.datetime.now() - summary["started"]).total_seconds()
+    logger.debug(section["name"] + ": Sync done")
+
+    return summary